@@ -1,10 +1,25 @@
 import os
+import re
+import sys
 import csv
+import hashlib
+import logging
 import sqlite3
-from datetime import date
+import threading
+import time
+import zlib
+from bisect import bisect_right
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import date, datetime
+from array import array
 from functools import wraps
+from itertools import chain, permutations, product
+from operator import attrgetter, itemgetter, methodcaller
 from StringIO import StringIO
-from flask import Flask, jsonify, request, abort, Response, make_response
+from flask import Flask, jsonify, request, abort, Response, make_response, g, has_app_context, \
+    json, _request_ctx_stack
+from werkzeug.wsgi import ClosingIterator
 
 app = Flask(__name__)
 
@@ -31,14 +46,94 @@ def getDatabase():
         database = os.path.join(app.root_path, '../data/brothers.db')
     return database
 
+
+def getMetrics():
+    return os.environ.get('METRICS', '') not in ('', '0', 'false')
+
 app.config.update(dict(
     DATABASE=getDatabase(),
     DEBUG=True,
     USERNAME=getUsername(),
-    PASSWORD=getPassword()
+    PASSWORD=getPassword(),
+    DB_POOL_SIZE=5,
+    DB_CACHE_SIZE=-8000,
+    DB_MMAP_SIZE=64 * 1024 * 1024,
+    # Prepared statements kept per connection: every fixed statement and every
+    # search shape (len(searchShapes()), 3784), so none is ever pushed out.
+    # Only the shapes a connection has run take up any room.
+    DB_STATEMENT_CACHE=4096,
+    IMPORT_BATCH_SIZE=500,
+    EXPORT_BATCH_SIZE=500,
+    STREAM_CHUNK_SIZE=16 * 1024,
+    # Large reads go out gzipped or deflated for clients that accept it, once
+    # they come to COMPRESS_MIN_SIZE bytes
+    COMPRESS_LEVEL=6,
+    COMPRESS_MIN_SIZE=1024,
+    # Per request instrumentation, off unless asked for. Totals from every
+    # worker are kept in METRICS_DATABASE, by default next to DATABASE.
+    METRICS=getMetrics(),
+    METRICS_DATABASE=os.environ.get('METRICS_PATH')
 ))
 
 
+# Answers 304 Not Modified from the revision stamp alone when the client's
+# copy is still current, without running the view at all
+def conditional(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        number, modified = getRevision()
+        # Everything besides the data that changes what the view sends back
+        variant = (request.path, request.query_string, _currentYear(), request.is_xhr,
+                   request.headers.get('Accept'), request.headers.get('Accept-Encoding'))
+        etag = '{0:d}-{1}'.format(number, hashlib.sha1(repr(variant)).hexdigest()[:16])
+        # The stamp only has whole seconds, so one from the current second
+        # may yet be shared by another write. It is neither sent nor trusted
+        # until that second is over; the ETag covers the meantime.
+        settled = modified < int(time.time())
+        lastModified = datetime.utcfromtimestamp(modified)
+        response = None
+        if request.if_none_match.star_tag:
+            # * only matches a representation that exists (RFC 7232, 3.2), so
+            # the view has to run to tell a missing brother from a current one
+            response = make_response(f(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            notModified = True
+        elif request.if_none_match:
+            notModified = request.if_none_match.contains(etag)
+        else:
+            since = request.if_modified_since
+            notModified = settled and since is not None and lastModified <= since
+        if notModified:
+            if response is not None:
+                # Lets a streamed body give back what it holds
+                response.close()
+            response = Response(status=304)
+        elif response is None:
+            response = make_response(f(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag)
+        if settled:
+            response.last_modified = lastModified
+        return response
+    return decorated
+
+
+# Adds headers to Vary on everything the view sends, including the 304s from
+# conditional, for views whose body depends on those request headers
+def varies(*headers):
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            response = make_response(f(*args, **kwargs))
+            for header in headers:
+                response.vary.add(header)
+            return response
+        return decorated
+    return decorator
+
+
 def requires_auth(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -49,198 +144,1664 @@ def requires_auth(f):
     return decorated
 
 
+# Kept in step with brothers on every write: the revision number, bumped by
+# any change, and the full text index of nicknames and names, which reads them
+# from brothers by rowid
+REVISION_TRIGGERS = [
+    "CREATE TRIGGER IF NOT EXISTS brothers_insert_revision AFTER INSERT ON brothers BEGIN "
+    "UPDATE revision SET number = number + 1, modified = strftime('%s', 'now'); END",
+    "CREATE TRIGGER IF NOT EXISTS brothers_update_revision AFTER UPDATE ON brothers BEGIN "
+    "UPDATE revision SET number = number + 1, modified = strftime('%s', 'now'); END",
+    "CREATE TRIGGER IF NOT EXISTS brothers_delete_revision AFTER DELETE ON brothers BEGIN "
+    "UPDATE revision SET number = number + 1, modified = strftime('%s', 'now'); END"
+]
+FTS_TRIGGERS = [
+    "CREATE TRIGGER IF NOT EXISTS brothers_fts_insert AFTER INSERT ON brothers BEGIN "
+    "INSERT INTO brothers_fts (rowid, nickname, name) VALUES (new.rowid, new.nickname, new.name); END",
+    "CREATE TRIGGER IF NOT EXISTS brothers_fts_delete AFTER DELETE ON brothers BEGIN "
+    "INSERT INTO brothers_fts (brothers_fts, rowid, nickname, name) VALUES ('delete', old.rowid, old.nickname, old.name); END",
+    "CREATE TRIGGER IF NOT EXISTS brothers_fts_update AFTER UPDATE OF nickname, name ON brothers BEGIN "
+    "INSERT INTO brothers_fts (brothers_fts, rowid, nickname, name) VALUES ('delete', old.rowid, old.nickname, old.name); "
+    "INSERT INTO brothers_fts (rowid, nickname, name) VALUES (new.rowid, new.nickname, new.name); END"
+]
+
+# Points everyone whose big was only known by nickname at that brother, for
+# those bigs who are now in the table
+RESOLVE_BIGS = ('UPDATE brothers SET big_id = (SELECT bigs.id FROM brothers bigs WHERE bigs.nickname = brothers.bigNickname), '
+                'bigNickname = NULL WHERE bigNickname IN (SELECT nickname FROM brothers)')
+
+# Schema changes in the order they were made. A database's PRAGMA user_version
+# is the number of migrations already applied to it.
+MIGRATIONS = [
+    [
+        'CREATE TABLE IF NOT EXISTS brothers (nickname TEXT PRIMARY KEY, name TEXT, big TEXT, year INT)'
+    ],
+    [
+        'CREATE INDEX IF NOT EXISTS brothers_big ON brothers (big)',
+        'CREATE INDEX IF NOT EXISTS brothers_year ON brothers (year)'
+    ],
+    [
+        # A single row bumped on every change to brothers, so each worker can
+        # tell cheaply whether what it has cached is stale
+        'CREATE TABLE IF NOT EXISTS revision (number INTEGER NOT NULL, modified INTEGER NOT NULL)',
+        "INSERT INTO revision (number, modified) VALUES (0, strftime('%s', 'now'))"
+    ] + REVISION_TRIGGERS,
+    [
+        # Each brother's subtree weight and the latest year in his subtree,
+        # kept up to date by every write so reads needn't walk the subtree.
+        # They are worked out once brothers has its current shape, below.
+        'ALTER TABLE brothers ADD COLUMN weight INTEGER NOT NULL DEFAULT 1',
+        'ALTER TABLE brothers ADD COLUMN maxYear INT'
+    ],
+    [
+        # A full text index over nicknames and names for searches
+        "CREATE VIRTUAL TABLE IF NOT EXISTS brothers_fts USING fts5(nickname, name, content='brothers')"
+    ] + FTS_TRIGGERS + [
+        "INSERT INTO brothers_fts (brothers_fts) VALUES ('rebuild')"
+    ],
+    [
+        # An integer id for every brother, so bigs are found by id and a new
+        # nickname is written to just his own row. big_id is his big's id;
+        # bigNickname holds his big's nickname only while no brother has it.
+        # Ids are the old rowids, which the search index already uses.
+        'CREATE TABLE brothers_new (id INTEGER PRIMARY KEY, nickname TEXT NOT NULL, name TEXT, '
+        'big_id INTEGER REFERENCES brothers (id), bigNickname TEXT, year INT, '
+        'weight INTEGER NOT NULL DEFAULT 1, maxYear INT)',
+        'INSERT INTO brothers_new (id, nickname, name, bigNickname, year, weight, maxYear) '
+        'SELECT rowid, nickname, name, big, year, weight, maxYear FROM brothers',
+        'DROP TABLE brothers',
+        'ALTER TABLE brothers_new RENAME TO brothers',
+        'CREATE UNIQUE INDEX brothers_nickname ON brothers (nickname)',
+        'CREATE INDEX brothers_big ON brothers (big_id)',
+        'CREATE INDEX brothers_bigNickname ON brothers (bigNickname)',
+        'CREATE INDEX brothers_year ON brothers (year)',
+        RESOLVE_BIGS
+    ] + REVISION_TRIGGERS + FTS_TRIGGERS + [
+        "INSERT INTO brothers_fts (brothers_fts) VALUES ('rebuild')",
+        lambda cur: rebuildAggregates(cur)
+    ],
+    [
+        # Sorts by year break ties by nickname, so the year index carries
+        # nickname too and pages come straight off it
+        'DROP INDEX brothers_year',
+        'CREATE INDEX brothers_year ON brothers (year, nickname)'
+    ]
+]
+
+# Brothers as the API has them, in table order: big is the nickname of the
+# brother big_id points at, or the nickname given for a big not in the table
+BIGS_JOIN = 'LEFT JOIN brothers bigs ON bigs.id = brothers.big_id'
+BROTHER_COLUMNS = ('brothers.nickname, brothers.name, COALESCE(bigs.nickname, brothers.bigNickname) AS big, '
+                   'brothers.year, brothers.weight, brothers.maxYear')
+BROTHER_ROWS = 'SELECT ' + BROTHER_COLUMNS + ' FROM brothers ' + BIGS_JOIN
+BROTHER_BY_NICKNAME = BROTHER_ROWS + ' WHERE brothers.nickname = ?'
+LITTLES_OF = BROTHER_ROWS + ' WHERE brothers.big_id = (SELECT id FROM brothers WHERE nickname = ?)'
+BROTHER_ID = 'SELECT id FROM brothers WHERE nickname = ?'
+BROTHER_EXISTS = 'SELECT 1 FROM brothers WHERE nickname = ?'
+REVISION = 'SELECT number, modified FROM revision'
+
+# The writes behind each endpoint, all keyed on nickname
+INSERT_BROTHER = 'INSERT INTO brothers (nickname, name, big_id, bigNickname, year) VALUES (?, ?, ?, ?, ?)'
+UPDATE_BROTHER = 'UPDATE brothers SET name=?, big_id=?, bigNickname=?, year=? WHERE nickname=?'
+# His littles go back to knowing their big by nickname alone
+RELEASE_LITTLES = 'UPDATE brothers SET big_id = NULL, bigNickname = ? WHERE big_id = (SELECT id FROM brothers WHERE nickname = ?)'
+DELETE_BROTHER = 'DELETE FROM brothers WHERE nickname = ?'
+RENAME_BROTHER = 'UPDATE brothers SET nickname = ? WHERE nickname = ?'
+ADOPT_LITTLES = 'UPDATE brothers SET big_id = ?, bigNickname = NULL WHERE bigNickname = ?'
+
+# The stored aggregates of one brother, read back from his own row and his
+# littles' rows
+AGGREGATE_ROW = 'SELECT big_id, year, weight, maxYear FROM brothers WHERE id = ?'
+LITTLES_AGGREGATES = 'SELECT 1 + COALESCE(SUM(weight), 0), MAX(maxYear) FROM brothers WHERE big_id = ? AND id != ?'
+SET_AGGREGATES = 'UPDATE brothers SET weight = ?, maxYear = ? WHERE id = ?'
+FIX_AGGREGATES = 'UPDATE brothers SET weight = ?, maxYear = ? WHERE nickname = ?'
+
+# Where a brother ranks among the matches, for picking up a rank-sorted page
+MATCH_RANK = 'SELECT rank FROM brothers_fts WHERE brothers_fts MATCH ? AND rowid = (SELECT id FROM brothers WHERE nickname = ?)'
+
+
+# Creates the database or upgrades an existing one in place
 def init_db():
-    conn = _get_conn()
-    cur = conn.cursor()
-    cur.execute('CREATE TABLE IF NOT EXISTS brothers (nickname TEXT PRIMARY KEY, name TEXT, big TEXT, year INT)')
-    cur.close()
-    conn.commit()
-    conn.close()
+    with app.app_context():
+        conn = _get_conn()
+        cur = conn.cursor()
+        # WAL is persistent, so setting it once here covers every connection
+        cur.execute('PRAGMA journal_mode=WAL')
+        while True:
+            with transaction(conn):
+                cur.execute('PRAGMA user_version')
+                version = cur.fetchone()[0]
+                if version >= len(MIGRATIONS):
+                    break
+                for statement in MIGRATIONS[version]:
+                    if callable(statement):
+                        statement(cur)
+                    else:
+                        cur.execute(statement)
+                cur.execute('PRAGMA user_version = {0:d}'.format(version + 1))
+        cur.close()
+        invalidateSnapshot()
+        return version
+
 
+# Runs the block in one explicit transaction. The sqlite3 module's own
+# transaction handling is switched off meanwhile, since it would commit early
+# on schema changes and savepoints. Anything that ends the block early rolls
+# it back, including a generator holding it being closed.
+@contextmanager
+def transaction(conn, mode='IMMEDIATE'):
+    conn.isolation_level = None
+    try:
+        conn.execute('BEGIN ' + mode)
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+    finally:
+        conn.isolation_level = ''
+
+
+# A connection that remembers the search statements it has run, which sqlite
+# keeps prepared for it
+class PooledConnection(sqlite3.Connection):
+    def __init__(self, *args, **kwargs):
+        sqlite3.Connection.__init__(self, *args, **kwargs)
+        self.prepared = set()
+
+
+# Keeps idle sqlite connections around between requests so each one doesn't
+# pay for connecting and tearing down. Every gunicorn worker gets its own pool.
+class ConnectionPool(object):
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._idle = []
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def acquire(self, database):
+        with self._lock:
+            # Connections must never be shared with a forked parent
+            if self._pid != os.getpid():
+                self._idle = []
+                self._pid = os.getpid()
+            instrumented = bool(app.config['METRICS'])
+            while self._idle:
+                path, conn = self._idle.pop()
+                # Connections opened before METRICS was switched are replaced
+                if path == database and isinstance(conn, InstrumentedConnection) == instrumented:
+                    self.hits += 1
+                    return conn
+                conn.close()
+            self.misses += 1
+        return self.connect(database)
+
+    def connect(self, database):
+        factory = InstrumentedConnection if app.config['METRICS'] else PooledConnection
+        conn = sqlite3.connect(database, check_same_thread=False, cached_statements=app.config['DB_STATEMENT_CACHE'],
+                               factory=factory)
+        metrics = _requestMetrics()
+        if metrics is not None:
+            metrics.connections += 1
+        conn.text_factory = str
+        cur = conn.cursor()
+        cur.execute('PRAGMA synchronous=NORMAL')
+        cur.execute('PRAGMA cache_size={0:d}'.format(app.config['DB_CACHE_SIZE']))
+        cur.execute('PRAGMA mmap_size={0:d}'.format(app.config['DB_MMAP_SIZE']))
+        cur.close()
+        return conn
+
+    def release(self, database, conn):
+        # Anything left uncommitted by a failed request is thrown away
+        conn.rollback()
+        with self._lock:
+            if self._pid == os.getpid() and len(self._idle) < app.config['DB_POOL_SIZE']:
+                self._idle.append((database, conn))
+                return
+        conn.close()
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for path, conn in idle:
+            conn.close()
 
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, idle=len(self._idle))
+
+
+pool = ConnectionPool()
+
+
+# One connection is checked out per app context and handed back at teardown
 def _get_conn():
-    conn = sqlite3.connect(app.config['DATABASE'])
-    conn.text_factory = str
+    conn = g.get('conn')
+    if conn is None:
+        g.database = app.config['DATABASE']
+        conn = g.conn = pool.acquire(g.database)
+        if isinstance(conn, InstrumentedConnection):
+            conn.metrics = _requestMetrics()
     return conn
 
 
-class Brother:
-    def __init__(self, nickname='', name='', big='', year=0):
+@app.teardown_appcontext
+def _release_conn(exception):
+    conn = g.get('conn')
+    if conn is not None:
+        g.conn = None
+        if isinstance(conn, InstrumentedConnection):
+            conn.metrics = None
+        pool.release(g.database, conn)
+
+
+# What one request cost. Brothers are counted from Brother.constructed, so
+# with a threaded server the count takes in other requests running alongside.
+class RequestMetrics(object):
+    def __init__(self):
+        self.start = time.time()
+        self.brothersBefore = Brother.constructed
+        self.connections = 0
+        self.queries = 0
+        self.rows = 0
+        self.sqlTime = 0.0
+        self.serializeTime = 0.0
+
+    def values(self):
+        return OrderedDict([
+            ('requests', 1),
+            ('request_seconds', time.time() - self.start),
+            ('connections_opened', self.connections),
+            ('sql_queries', self.queries),
+            ('sql_seconds', self.sqlTime),
+            ('sql_rows', self.rows),
+            ('brothers_constructed', Brother.constructed - self.brothersBefore),
+            ('serialize_seconds', self.serializeTime)
+        ])
+
+    def serverTiming(self):
+        return ', '.join([
+            'total;dur={0:.3f}'.format((time.time() - self.start) * 1000),
+            'sql;dur={0:.3f};desc="{1:d} queries, {2:d} rows"'.format(self.sqlTime * 1000, self.queries, self.rows),
+            'serialize;dur={0:.3f}'.format(self.serializeTime * 1000),
+            'brothers;desc="{0:d} constructed"'.format(Brother.constructed - self.brothersBefore),
+            'connections;desc="{0:d} opened"'.format(self.connections)
+        ])
+
+
+PROMETHEUS_TYPE = 'text/plain; version=0.0.4'
+METRIC_HELP = dict(
+    requests='Requests handled',
+    request_seconds='Time spent handling requests, including streaming their bodies',
+    connections_opened='Database connections opened',
+    sql_queries='SQL statements run',
+    sql_seconds='Time spent running SQL and fetching rows',
+    sql_rows='Rows fetched',
+    brothers_constructed='Brother objects built',
+    serialize_seconds='Time spent serializing brothers'
+)
+
+
+def _requestMetrics():
+    if has_app_context():
+        return g.get('metrics')
+    return None
+
+
+# Times the block as serialization for the current request, if instrumented
+@contextmanager
+def serializing():
+    metrics = _requestMetrics()
+    if metrics is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        metrics.serializeTime += time.time() - start
+
+
+# Streams the chunks, counting the time spent making them as serialization
+# for the current request, if instrumented
+def serializingChunks(chunks):
+    metrics = _requestMetrics()
+    if metrics is None:
+        return chunks
+    return _timedChunks(metrics, chunks)
+
+
+def _timedChunks(metrics, chunks):
+    chunks = iter(chunks)
+    while True:
+        start = time.time()
+        try:
+            chunk = next(chunks)
+        finally:
+            metrics.serializeTime += time.time() - start
+        yield chunk
+
+
+# Used for every connection while METRICS is on. The metrics of the request
+# that has the connection checked out are charged for each statement and
+# fetch.
+class InstrumentedConnection(PooledConnection):
+    metrics = None
+
+    def cursor(self, factory=None):
+        return sqlite3.Connection.cursor(self, factory or InstrumentedCursor)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def _timed(self, method, args, queries=0):
+        metrics = self.connection.metrics
+        if metrics is None:
+            return method(self, *args)
+        start = time.time()
+        try:
+            result = method(self, *args)
+        finally:
+            metrics.sqlTime += time.time() - start
+            metrics.queries += queries
+        if isinstance(result, list):
+            metrics.rows += len(result)
+        elif isinstance(result, tuple):
+            metrics.rows += 1
+        return result
+
+    def execute(self, *args):
+        return self._timed(sqlite3.Cursor.execute, args, 1)
+
+    def executemany(self, *args):
+        return self._timed(sqlite3.Cursor.executemany, args, 1)
+
+    def fetchone(self):
+        return self._timed(sqlite3.Cursor.fetchone, ())
+
+    def fetchmany(self, *args):
+        return self._timed(sqlite3.Cursor.fetchmany, args)
+
+    def fetchall(self):
+        return self._timed(sqlite3.Cursor.fetchall, ())
+
+
+# Request totals from every worker, summed in one small sqlite table
+class MetricsStore(object):
+    def __init__(self):
+        self._conn = None
+        self._path = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        path = app.config['METRICS_DATABASE'] or app.config['DATABASE'] + '.metrics'
+        if self._conn is None or self._path != path or self._pid != os.getpid():
+            self._conn = sqlite3.connect(path, check_same_thread=False, timeout=1, isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS metrics (name TEXT NOT NULL, endpoint TEXT NOT NULL, '
+                'value REAL NOT NULL, PRIMARY KEY (name, endpoint))'
+            )
+            self._path = path
+            self._pid = os.getpid()
+        return self._conn
+
+    def record(self, endpoint, values):
+        cmd = ('INSERT INTO metrics (name, endpoint, value) VALUES (?, ?, ?) '
+               'ON CONFLICT (name, endpoint) DO UPDATE SET value = value + excluded.value')
+        with self._lock:
+            conn = self._connect()
+            with transaction(conn):
+                conn.executemany(cmd, [(name, endpoint, value) for name, value in values.iteritems()])
+
+    def read(self):
+        with self._lock:
+            cur = self._connect().execute('SELECT name, endpoint, value FROM metrics ORDER BY name, endpoint')
+            return cur.fetchall()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+            self._conn = None
+
+
+metricsStore = MetricsStore()
+metricsLog = logging.getLogger('dpl.metrics')
+
+
+@app.before_request
+def _startMetrics():
+    if app.config['METRICS']:
+        g.metrics = RequestMetrics()
+
+
+# The header goes out with what is known so far. Streamed bodies are still
+# being made after this, so the log line and the totals wait until the
+# response is closed.
+@app.after_request
+def _reportMetrics(response):
+    requestMetrics = g.get('metrics')
+    if requestMetrics is None:
+        return response
+    response.headers['Server-Timing'] = requestMetrics.serverTiming()
+    endpoint = request.endpoint or 'none'
+    method = request.method
+    path = request.path
+
+    def finish():
+        values = requestMetrics.values()
+        fields = OrderedDict([('method', method), ('path', path), ('endpoint', endpoint),
+                              ('status', response.status_code)])
+        fields.update(values)
+        metricsLog.info(json.dumps(fields))
+        try:
+            metricsStore.record(endpoint, values)
+        except sqlite3.Error:
+            metricsLog.exception('Could not record metrics')
+    response.call_on_close(finish)
+    return response
+
+
+# Brothers loaded during the current request, keyed by nickname, so that the
+# same row is never fetched or built twice. Writes clear it.
+def _loadedBrothers():
+    if not has_app_context():
+        return {}
+    if 'brothers' not in g:
+        g.brothers = {}
+    return g.brothers
+
+
+# Drops everything cached from before a write
+def _written():
+    if has_app_context():
+        g.brothers = {}
+        g.revision = None
+    invalidateSnapshot()
+
+
+# The path column holds every id visited so far, separated by char(31), so
+# that a big turning up twice (a loop of big pointers) ends the walk
+ANCESTORS = ('WITH RECURSIVE ancestors (id, depth, path) AS ('
+             'SELECT big_id, 1, char(31) || id || char(31) FROM brothers WHERE nickname = ? '
+             'UNION ALL '
+             'SELECT b.big_id, a.depth + 1, a.path || b.id || char(31) '
+             'FROM ancestors a JOIN brothers b ON b.id = a.id '
+             'WHERE instr(a.path || b.id || char(31), char(31) || b.big_id || char(31)) = 0) '
+             'SELECT brothers.nickname, brothers.name, COALESCE(bigs.nickname, brothers.bigNickname), brothers.year, a.depth '
+             'FROM ancestors a JOIN brothers ON brothers.id = a.id ' + BIGS_JOIN + ' '
+             'WHERE instr(a.path, char(31) || a.id || char(31)) = 0 '
+             'ORDER BY a.depth')
+
+DESCENDANTS = ('WITH RECURSIVE descendants (id, depth) AS ('
+               'SELECT id, 0 FROM brothers WHERE nickname = ? '
+               'UNION ALL '
+               'SELECT b.id, d.depth + 1 '
+               'FROM descendants d JOIN brothers b ON b.big_id = d.id '
+               'WHERE d.depth < ? AND b.nickname != ?) '
+               'SELECT brothers.nickname, brothers.name, COALESCE(bigs.nickname, brothers.bigNickname), brothers.year, d.depth '
+               'FROM descendants d JOIN brothers ON brothers.id = d.id ' + BIGS_JOIN + ' '
+               'WHERE d.depth > 0 '
+               'ORDER BY d.depth, brothers.nickname LIMIT ? OFFSET ?')
+
+
+# The year a brother must graduate in or after to count as active. Read once
+# per request so every node in a tree is judged against the same year.
+def _currentYear():
+    if not has_app_context():
+        return date.today().year
+    if 'currentYear' not in g:
+        g.currentYear = date.today().year
+    return g.currentYear
+
+
+class Brother(object):
+    __slots__ = ('name', 'nickname', 'big', 'year', '_littles', '_weight', '_maxYear', '_activeBranch')
+
+    # How many have ever been built, for instrumentation
+    constructed = 0
+
+    def __init__(self, nickname='', name='', big='', year=0, littles=None, weight=None, maxYear=None):
+        Brother.constructed += 1
         self.name = name
         self.nickname = nickname
         self.big = big
         self.year = year
-        self.littles = self.getLittles()
-        self.weight = self.getWeight()
-        self.activeBranch = False
-        self.activeBranch = self.isActiveBranch()
+        # Littles may be handed in, in any order, otherwise they are only
+        # loaded from the database once needed
+        self.littles = littles
+        # Aggregates stored in the database can be handed in too, so he
+        # needn't walk his subtree to work them out
+        if weight is not None:
+            self._weight = weight
+            self._maxYear = maxYear
+            self._activeBranch = maxYear >= _currentYear()
+
+    @staticmethod
+    def fromRow(row):
+        brothers = _loadedBrothers()
+        brother = brothers.get(row[0])
+        if brother is None:
+            brother = Brother(row[0], row[1], row[2], row[3], weight=row[4], maxYear=row[5])
+            brothers[row[0]] = brother
+        return brother
+
+    @property
+    def littles(self):
+        if self._weight is None:
+            self.aggregate()
+        elif self._littles is None:
+            # Stored weights are all sorting needs, so only this one level
+            # is loaded
+            self._littles = Brother.sortLittles(self.getLittles())
+        return self._littles
+
+    @littles.setter
+    def littles(self, littles):
+        self._littles = littles
+        self._weight = None
+        self._maxYear = None
+        self._activeBranch = None
+
+    @property
+    def weight(self):
+        if self._weight is None:
+            self.aggregate()
+        return self._weight
+
+    @property
+    def activeBranch(self):
+        if self._weight is None:
+            self.aggregate()
+        return self._activeBranch
 
     def __lt__(self, other):
         return self.weight > other.weight
 
+    # Works out littles (in display order), weight, the latest year and
+    # activeBranch for this brother and everyone below him in one
+    # aggregateSubtrees pass. Littles not handed in are loaded as the pass
+    # reaches them, and anyone already worked out is skipped.
+    def aggregate(self, currentYear=None):
+        if currentYear is None:
+            currentYear = _currentYear()
+        aggregateSubtrees([self], methodcaller('_loadedLittles'), attrgetter('year'), methodcaller('_aggregates'),
+                          lambda bro, *aggregates: bro._setAggregates(*aggregates), currentYear)
+
+    def _loadedLittles(self):
+        if self._littles is None:
+            self._littles = self.getLittles()
+        return self._littles
+
+    def _aggregates(self):
+        return None if self._weight is None else (self._weight, self._maxYear)
+
+    def _setAggregates(self, littles, weight, maxYear, activeBranch):
+        self._littles = littles
+        self._weight = weight
+        self._maxYear = maxYear
+        self._activeBranch = activeBranch
+
     def isActiveBranch(self):
-        currentYear = date.today().year
-        if self.year >= currentYear or self.activeBranch:
-            return True
-        elif any(little.isActiveBranch() for little in self.littles):
-            return True
-        else:
-            return False
+        return self.activeBranch
 
     def serialize(self, littles=True):
+        with serializing():
+            return self._serialize(littles)
+
+    # Brothers read one level at a time know nothing of cycles of big
+    # pointers, so anyone already above on the way down is left out
+    def _serialize(self, littles, above=None):
         obj = {}
         obj['name'] = self.name
         obj['nickname'] = self.nickname
         obj['big'] = self.big
         obj['year'] = self.year
         if littles:
+            above = set() if above is None else above
+            above.add(self.nickname)
             obj['littles'] = []
             for i in self.littles:
-                obj['littles'].append(i.serialize())
+                if i.nickname not in above:
+                    obj['littles'].append(i._serialize(True, above))
+            above.discard(self.nickname)
             obj['activeBranch'] = self.activeBranch
         return obj
 
     def create(self):
         conn = _get_conn()
         cur = conn.cursor()
-        t = (self.nickname, self.name, self.big, self.year)
-        cmd = 'INSERT INTO brothers (nickname, name, big, year) VALUES (?, ?, ?, ?)'
-        cur.execute(cmd, t)
+        with transaction(conn):
+            self._create(cur)
         cur.close()
-        conn.commit()
-        conn.close()
-        self.littles = self.getLittles()
+        _written()
+        self.littles = None
         return self
 
+    # The writes themselves, on the caller's cursor and left uncommitted. The
+    # callers hold the write lock from the start, so the bigs looked up here
+    # can't change before they're written.
+    def _create(self, cur):
+        t = (self.nickname, self.name) + _bigColumns(cur, self.big) + (self.year,)
+        cur.execute(INSERT_BROTHER, t)
+        # He may adopt littles already pointing at him
+        _adoptLittles(cur, cur.lastrowid, self.nickname)
+        refreshAggregates(cur, [self.nickname, self.big])
+
     def read(self):
+        brother = _loadedBrothers().get(_toStr(self.nickname))
+        if brother is not None:
+            return brother
         conn = _get_conn()
         cur = conn.cursor()
         t = (self.nickname,)
-        cmd = 'SELECT * FROM brothers WHERE nickname = ?'
-        cur.execute(cmd, t)
+        cur.execute(BROTHER_BY_NICKNAME, t)
         data = cur.fetchone()
         cur.close()
-        conn.close()
         if data:
-            self.__init__(data[0], data[1], data[2], data[3])
-            return self
+            return Brother.fromRow(data)
         else:
             return None
 
     def update(self):
         conn = _get_conn()
         cur = conn.cursor()
-        t = (self.name, self.big, self.year, self.nickname)
-        cmd = 'UPDATE brothers SET name=?, big=?, year=? WHERE nickname=?'
-        cur.execute(cmd, t)
+        with transaction(conn):
+            self._update(cur)
         cur.close()
-        conn.commit()
-        conn.close()
-        self.littles = self.getLittles()
+        _written()
+        self.littles = None
         return self
 
+    def _update(self, cur):
+        oldBig = _bigOf(cur, self.nickname)
+        t = (self.name,) + _bigColumns(cur, self.big) + (self.year, self.nickname)
+        cur.execute(UPDATE_BROTHER, t)
+        refreshAggregates(cur, [self.nickname, self.big, oldBig])
+
     def delete(self):
         conn = _get_conn()
         cur = conn.cursor()
-        t = (self.nickname,)
-        cmd = 'DELETE FROM brothers WHERE nickname = ?'
-        cur.execute(cmd, t)
+        with transaction(conn):
+            self._delete(cur)
         cur.close()
-        conn.commit()
-        conn.close()
+        _written()
         return True
 
+    def _delete(self, cur):
+        oldBig = _bigOf(cur, self.nickname)
+        cur.execute(RELEASE_LITTLES, (self.nickname, self.nickname))
+        cur.execute(DELETE_BROTHER, (self.nickname,))
+        refreshAggregates(cur, [oldBig])
+
     def changeNickname(self, newNickname):
         conn = _get_conn()
         cur = conn.cursor()
-        t = (newNickname, self.nickname)
-        cmd = 'UPDATE brothers SET nickname = ? WHERE nickname = ?'
-        cur.execute(cmd, t)
-        cmd = 'UPDATE brothers SET big = ? WHERE big = ?'
-        cur.execute(cmd, t)
+        with transaction(conn):
+            self._changeNickname(cur, newNickname)
         cur.close()
-        conn.commit()
-        conn.close()
+        _written()
         return True
 
+    # His littles point at his id, so only his own row changes
+    def _changeNickname(self, cur, newNickname):
+        t = (newNickname, self.nickname)
+        cur.execute(RENAME_BROTHER, t)
+        # Anyone already naming the new nickname as his big becomes a little
+        cur.execute(BROTHER_ID, (newNickname,))
+        row = cur.fetchone()
+        if row and _adoptLittles(cur, row[0], newNickname):
+            refreshAggregates(cur, [newNickname, _bigOf(cur, newNickname)])
+
+    # Bigs all the way up, nearest first, each with how many generations up
+    # it is
+    def getAncestors(self):
+        conn = _get_conn()
+        cur = conn.cursor()
+        t = (self.nickname,)
+        cur.execute(ANCESTORS, t)
+        res = cur.fetchall()
+        cur.close()
+        return res
+
+    # Littles, their littles and so on, up to depth generations down,
+    # ordered by generation then nickname. Only this brother can be reached
+    # twice (when the big pointers loop back to him), so he is skipped.
+    def getDescendants(self, depth=None, limit=None, offset=0):
+        conn = _get_conn()
+        cur = conn.cursor()
+        t = (self.nickname, sys.maxint if depth is None else depth, self.nickname,
+             -1 if limit is None else limit, offset)
+        cur.execute(DESCENDANTS, t)
+        res = cur.fetchall()
+        cur.close()
+        return res
+
+    # Direct littles straight from the database, not yet in display order
     def getLittles(self):
         conn = _get_conn()
         cur = conn.cursor()
         t = (self.nickname,)
-        cmd = 'SELECT * FROM brothers WHERE big = ?'
-        cur.execute(cmd, t)
+        cur.execute(LITTLES_OF, t)
         res = cur.fetchall()
         cur.close()
-        conn.close()
         littles = []
         for i in res:
-            littles.append(Brother(i[0], i[1], i[2], i[3]))
-        return self.sortLittles(littles)
-
-    def sortLittles(self, littles):
-        res = []
-        littles.sort()
-        if len(littles) % 2:
-            res.append(littles.pop(0))
-        while len(littles):
-            res.insert(0, littles.pop(0))
-            res.append(littles.pop(0))
-            if len(littles):
-                res.insert(0, littles.pop())
-                res.append(littles.pop())
-        return res
+            littles.append(Brother.fromRow(i))
+        return littles
+
+    # Heaviest little in the middle (when there's an odd number of them).
+    # Going from the heavy end, then the light end, then the heavy end again,
+    # each pair taken is split to the outside of the left and right sides.
+    # weight looks up each little's weight, for littles that aren't Brothers.
+    @staticmethod
+    def sortLittles(littles, weight=attrgetter('weight')):
+        # reverse keeps equal weights in their original order, as __lt__ does
+        ordered = deque(sorted(littles, key=weight, reverse=True))
+        left = []
+        center = []
+        right = []
+        if len(ordered) % 2:
+            center.append(ordered.popleft())
+        while ordered:
+            left.append(ordered.popleft())
+            right.append(ordered.popleft())
+            if ordered:
+                left.append(ordered.pop())
+                right.append(ordered.pop())
+        left.reverse()
+        return left + center + right
 
     def getWeight(self):
-        weight = 1
-        for i in self.littles:
-            weight += i.weight
-        return weight
+        return self.weight
+
+
+# The one post-order pass behind both Brother.aggregate and TreeStore, over
+# brothers however they are held. From each start in turn it works out, for
+# everyone below him not yet worked out, his littles in display order, his
+# weight, the latest year in his subtree and whether that makes his an active
+# branch, and hands them to finish(brother, littles, weight, maxYear,
+# activeBranch). littlesOf(brother) gives his littles in table order and
+# aggregates(brother) his (weight, maxYear), or None until he's been worked out.
+# A little still unfinished when his big is finished is his own ancestor
+# through a loop of big pointers, so he is left out: with starts in table
+# order, that is the loop's first brother in table order.
+def aggregateSubtrees(starts, littlesOf, yearOf, aggregates, finish, currentYear):
+    visiting = set()
+    for start in starts:
+        stack = [(start, None)]
+        while stack:
+            bro, littles = stack.pop()
+            if littles is None:
+                if bro in visiting or aggregates(bro) is not None:
+                    continue
+                visiting.add(bro)
+                littles = littlesOf(bro)
+                stack.append((bro, littles))
+                for little in littles:
+                    if little not in visiting and aggregates(little) is None:
+                        stack.append((little, None))
+            else:
+                weight = 1
+                maxYear = yearOf(bro)
+                kept = []
+                for little in littles:
+                    values = aggregates(little)
+                    if values is not None:
+                        kept.append((values[0], little))
+                        weight += values[0]
+                        maxYear = max(maxYear, values[1])
+                kept = [little for _, little in Brother.sortLittles(kept, itemgetter(0))]
+                finish(bro, kept, weight, maxYear, maxYear >= currentYear)
+                visiting.discard(bro)
 
 
 def getAllBrothers():
     conn = _get_conn()
     cur = conn.cursor()
-    cur.execute('SELECT * FROM brothers')
+    cur.execute(BROTHER_ROWS)
     brothers = cur.fetchall()
     cur.close()
-    conn.close()
     return brothers
 
 
-def makeSearchQuery(params, default, sort):
-    requiredFields = ()
-    requiredValues = ()
-    optionalFields = ()
-    optionalValues = ()
-    for k, v in params.iteritems():
-        if v:
-            requiredFields = requiredFields + (k + ' like ?',)
-            requiredValues = requiredValues + ('%' + v + '%',)
+# Every brother from one read of the brothers table, held in parallel
+# columns indexed by table position instead of as a Brother each: weights,
+# parents and the active flag in arrays, nicknames, names and bigs interned
+# (so each known big is the same string as his nickname, and names shared by
+# several brothers are held once), and each brother's littles, in display order,
+# as the range littles[littleStarts[i]:littleStarts[i + 1]]. parents[i] is -1
+# for anyone who isn't in a big's littles. Looked up by nickname like a dict,
+# it hands out StoredBrother views.
+class TreeStore(object):
+    def __init__(self, rows, currentYear):
+        self.nicknames = []
+        self.names = []
+        self.bigs = []
+        self.years = []
+        self.index = {}
+        for row in rows:
+            nickname = _interned(row[0])
+            self.index[nickname] = len(self.nicknames)
+            self.nicknames.append(nickname)
+            self.names.append(_interned(row[1]))
+            self.bigs.append(_interned(row[2]))
+            self.years.append(row[3])
+        size = len(self.nicknames)
+        # Each counts as a brother built, for instrumentation
+        Brother.constructed += size
+        self.weights = array('l', [0]) * size
+        self.maxYears = [None] * size
+        self.active = bytearray(size)
+        self.parents = array('l', [-1]) * size
+        starts, littles, counts = self._aggregate(currentYear)
+        self.littleStarts = array('l', [0])
+        self.littles = array('l')
+        for i in xrange(size):
+            kept = littles[starts[i]:starts[i] + counts[i]]
+            for little in kept:
+                self.parents[little] = i
+            self.littles.extend(kept)
+            self.littleStarts.append(len(self.littles))
+
+    # aggregateSubtrees over positions, from each brother in table order. Each
+    # brother's littles are found in table order at littles[starts[i]:starts[i + 1]]
+    # and the first counts[i] of them are then overwritten with the ones kept,
+    # in display order.
+    def _aggregate(self, currentYear):
+        size = len(self.nicknames)
+        bigs = array('l', [-1]) * size
+        starts = array('l', [0]) * (size + 1)
+        for i, big in enumerate(self.bigs):
+            big = self.index.get(big)
+            if big is not None:
+                bigs[i] = big
+                starts[big + 1] += 1
+        for i in xrange(size):
+            starts[i + 1] += starts[i]
+        littles = array('l', [0]) * starts[size]
+        filled = starts[:size]
+        for i in xrange(size):
+            if bigs[i] >= 0:
+                littles[filled[bigs[i]]] = i
+                filled[bigs[i]] += 1
+        counts = array('l', [0]) * size
+        done = bytearray(size)
+
+        def aggregates(i):
+            return (self.weights[i], self.maxYears[i]) if done[i] else None
+
+        def finish(i, kept, weight, maxYear, activeBranch):
+            littles[starts[i]:starts[i] + len(kept)] = array('l', kept)
+            counts[i] = len(kept)
+            self.weights[i] = weight
+            self.maxYears[i] = maxYear
+            self.active[i] = activeBranch
+            done[i] = 1
+
+        aggregateSubtrees(xrange(size), lambda i: littles[starts[i]:starts[i + 1]], self.years.__getitem__,
+                          aggregates, finish, currentYear)
+        return starts, littles, counts
+
+    def __len__(self):
+        return len(self.nicknames)
+
+    def __contains__(self, nickname):
+        return nickname in self.index
+
+    def __iter__(self):
+        return iter(self.nicknames)
+
+    def __getitem__(self, nickname):
+        return StoredBrother(self, self.index[nickname])
+
+    def get(self, nickname, default=None):
+        i = self.index.get(nickname)
+        return default if i is None else StoredBrother(self, i)
+
+    def keys(self):
+        return list(self.nicknames)
+
+    def itervalues(self):
+        for i in xrange(len(self.nicknames)):
+            yield StoredBrother(self, i)
+
+    def values(self):
+        return list(self.itervalues())
+
+    def littlesOf(self, i):
+        return self.littles[self.littleStarts[i]:self.littleStarts[i + 1]]
+
+
+# A Brother read out of a TreeStore. He holds nothing but his position, so
+# they are made as needed and cost next to nothing to throw away.
+class StoredBrother(Brother):
+    __slots__ = ('_store', '_i')
+
+    def __init__(self, store, i):
+        self._store = store
+        self._i = i
+
+    @property
+    def nickname(self):
+        return self._store.nicknames[self._i]
+
+    @property
+    def name(self):
+        return self._store.names[self._i]
+
+    @property
+    def big(self):
+        return self._store.bigs[self._i]
+
+    @property
+    def year(self):
+        return self._store.years[self._i]
+
+    @property
+    def littles(self):
+        return [StoredBrother(self._store, little) for little in self._store.littlesOf(self._i)]
+
+    @property
+    def weight(self):
+        return self._store.weights[self._i]
+
+    @property
+    def activeBranch(self):
+        return bool(self._store.active[self._i])
+
+    @property
+    def _maxYear(self):
+        return self._store.maxYears[self._i]
+
+
+# Rows come back as byte strings, since connections read text as str. NULLs
+# and anything handed in by hand that isn't a str are kept as they are.
+def _interned(value):
+    return intern(value) if type(value) is str else value
+
+
+# The whole table from a single read, in table order
+def buildTree(rows):
+    return TreeStore(rows, _currentYear())
+
+
+def getTree():
+    return buildTree(getAllBrothers())
+
+
+def _bigOf(cur, nickname):
+    cur.execute(BROTHER_BY_NICKNAME, (nickname,))
+    row = cur.fetchone()
+    return row[2] if row else None
+
+
+# big_id and bigNickname for a big given by nickname
+def _bigColumns(cur, big):
+    cur.execute(BROTHER_ID, (big,))
+    row = cur.fetchone()
+    return (row[0], None) if row else (None, big)
+
+
+# Points everyone waiting on a big by this nickname at his id. Returns whether
+# there was anyone.
+def _adoptLittles(cur, id, nickname):
+    cur.execute(ADOPT_LITTLES, (id, nickname))
+    return cur.rowcount > 0
+
+
+# Recomputes the stored weight and maxYear of each given brother from his own
+# year and his littles' stored values, then his big's, and so on up until a
+# brother comes out unchanged. Call it with everyone whose littles or year
+# were just changed, inside the same transaction as the change.
+#
+# A loop of big pointers is cut where aggregateSubtrees cuts it when the tree
+# is rebuilt: its first brother in table order, which is id order, heads it
+# and is left out of his big's littles. A walk that reaches a loop redoes all
+# of it from his big up to him, since the write may have just closed it.
+def refreshAggregates(cur, nicknames):
+    # Every row read, kept in step with what is written
+    rows = {}
+    for nickname in OrderedDict.fromkeys(nicknames):
+        cur.execute(BROTHER_ID, (nickname,))
+        row = cur.fetchone()
+        path, loopStart = _pathUp(cur, row[0] if row else None, rows)
+        if loopStart is None:
+            below, loop = path, []
+        else:
+            below, loop = path[:loopStart], path[loopStart:]
+            first = loop.index(min(loop))
+            loop = loop[first + 1:] + loop[:first + 1]
+        for id in below:
+            if not _refreshRow(cur, rows, id, id):
+                break
+        else:
+            for id in loop:
+                # The head comes last, so loop[0] is his big
+                _refreshRow(cur, rows, id, loop[-1] if id == loop[0] else id)
+
+
+# Ids from the brother with this id up through his bigs, nearest first, with
+# their AGGREGATE_ROWs added to rows. Also returns where in the path a loop
+# of big pointers starts, or None if the path reaches the top of a lineage.
+def _pathUp(cur, id, rows):
+    path = []
+    positions = {}
+    while id is not None and id not in positions:
+        if id not in rows:
+            cur.execute(AGGREGATE_ROW, (id,))
+            rows[id] = cur.fetchone()
+            if rows[id] is None:
+                break
+        positions[id] = len(path)
+        path.append(id)
+        id = rows[id][0]
+    return path, positions.get(id)
+
+
+# Recomputes one brother's aggregates from his littles besides the one with
+# id leftOut, writing them back if they changed. Returns whether they did.
+def _refreshRow(cur, rows, id, leftOut):
+    bigId, year, weight, maxYear = rows[id]
+    cur.execute(LITTLES_AGGREGATES, (id, leftOut))
+    newWeight, newMaxYear = cur.fetchone()
+    # Python 2 and sqlite order NULLs, numbers and text alike
+    newMaxYear = max(year, newMaxYear)
+    if newWeight == weight and newMaxYear == maxYear:
+        return False
+    cur.execute(SET_AGGREGATES, (newWeight, newMaxYear, id))
+    rows[id] = (bigId, year, newWeight, newMaxYear)
+    return True
+
+
+# Recomputes every stored weight and maxYear from scratch and returns the
+# nicknames whose stored values had drifted, fixing them unless dryRun
+def rebuildAggregates(cur, dryRun=False):
+    cur.execute(BROTHER_ROWS)
+    rows = cur.fetchall()
+    store = buildTree(rows)
+    drifted = []
+    for i, row in enumerate(rows):
+        if (row[4], row[5]) != (store.weights[i], store.maxYears[i]):
+            drifted.append((store.weights[i], store.maxYears[i], row[0]))
+    if not dryRun:
+        cur.executemany(FIX_AGGREGATES, drifted)
+    return [nickname for weight, maxYear, nickname in drifted]
+
+
+# Checks the stored aggregates against a full recompute, for init_db.py.
+# Rebuilding also links up any bigs only known by nickname and redoes the
+# search index, for rows written behind dpl's back.
+def verify_db(rebuild=False):
+    with app.app_context():
+        conn = _get_conn()
+        cur = conn.cursor()
+        with transaction(conn):
+            if rebuild:
+                cur.execute(RESOLVE_BIGS)
+            drifted = rebuildAggregates(cur, not rebuild)
+            if rebuild:
+                cur.execute("INSERT INTO brothers_fts (brothers_fts) VALUES ('rebuild')")
+        cur.close()
+        if drifted and rebuild:
+            invalidateSnapshot()
+        return drifted
+
+
+# The revision number and the unix time it was last bumped, read once per
+# request until that request writes
+def getRevision():
+    revision = g.get('revision')
+    if revision is None:
+        conn = _get_conn()
+        cur = conn.cursor()
+        cur.execute(REVISION)
+        revision = g.revision = cur.fetchone()
+        cur.close()
+    return revision
+
+
+# The built tree for one revision of the brothers table, along with anything
+# derived from it that is worth keeping until the next write
+class TreeSnapshot(object):
+    def __init__(self, key):
+        self.key = key
+        self.tree = getTree()
+        self._derived = {}
+
+    def derive(self, name, build):
+        if name not in self._derived:
+            self._derived[name] = build(self)
+        return self._derived[name]
+
+    def derived(self, name):
+        return self._derived.get(name)
+
+    def keep(self, name, value):
+        self._derived[name] = value
+
+
+_snapshot = None
+
+
+# Writes from other workers show up as a new revision. The year is part of
+# the key because it decides which branches are active.
+def getSnapshot():
+    global _snapshot
+    key = (app.config['DATABASE'], getRevision()[0], _currentYear())
+    snapshot = _snapshot
+    if snapshot is None or snapshot.key != key:
+        snapshot = _snapshot = TreeSnapshot(key)
+    return snapshot
+
+
+def invalidateSnapshot():
+    global _snapshot
+    _snapshot = None
+
+
+def _toStr(value):
+    # Rows come back as utf-8 byte strings, request values as unicode
+    if isinstance(value, unicode):
+        return value.encode('utf_8')
+    return value
+
+
+# Bigs are written by nickname, since they may come later in the file, and
+# linked up by RESOLVE_BIGS once every row is in
+UPSERT = ('INSERT INTO brothers (nickname, name, bigNickname, year) VALUES (?, ?, ?, ?) '
+          'ON CONFLICT (nickname) DO UPDATE SET name = excluded.name, big_id = NULL, '
+          'bigNickname = excluded.bigNickname, year = excluded.year')
+
+
+# Creates or updates a brother for every row of a csv.DictReader, in batches
+# within a single transaction. Returns a message for every row that failed.
+def importBrothers(reader):
+    errors = []
+    written = 0
+    conn = _get_conn()
+    cur = conn.cursor()
+    with transaction(conn):
+        batch = []
+        for row in reader:
+            if not row['Nickname']:
+                errors.append('Line {0:d} has no nickname'.format(reader.line_num))
+                continue
+            batch.append((row['Nickname'], row['Name'], row['Big'], row['Year']))
+            if len(batch) == app.config['IMPORT_BATCH_SIZE']:
+                written += _upsertBatch(cur, batch, errors)
+                batch = []
+        written += _upsertBatch(cur, batch, errors)
+        if written:
+            cur.execute(RESOLVE_BIGS)
+        # Walking up from every imported row would revisit the same bigs over
+        # and over, so the stored aggregates are redone in one pass instead
+        rebuildAggregates(cur)
+    cur.close()
+    _written()
+    return errors
+
+
+# Adds a message to errors for every row that failed and returns how many
+# were written
+def _upsertBatch(cur, batch, errors):
+    failed = 0
+    cur.execute('SAVEPOINT batch')
+    try:
+        cur.executemany(UPSERT, batch)
+    except Exception:
+        # Redo the batch a row at a time to find out which rows failed
+        cur.execute('ROLLBACK TO batch')
+        for values in batch:
+            try:
+                cur.execute(UPSERT, values)
+            except Exception, e:
+                errors.append(str(e))
+                failed += 1
+    cur.execute('RELEASE batch')
+    return len(batch) - failed
+
+
+# Everything a brother can be projected down to with ?fields=
+FIELDS = ('activeBranch', 'big', 'littles', 'name', 'nickname', 'weight', 'year')
+TREE_FIELDS = ('activeBranch', 'big', 'littles', 'name', 'nickname', 'year')
+ROOT_FIELDS = ('activeBranch', 'big', 'name', 'nickname', 'weight', 'year')
+SEARCH_FIELDS = ('big', 'name', 'nickname', 'year')
+SEARCH_COLUMNS = ('nickname', 'name', 'big', 'year')
+
+
+# Writes {"brothers": [...]} for the given Brothers a piece at a time, laid out
+# exactly as jsonify would lay out their serialize() output. Compact output
+# drops all whitespace. Only the given fields are written, and a "next" cursor
+# if one is given.
+def iterTreeJson(brothers, pretty=True, compact=False, fields=TREE_FIELDS, nextAfter=None):
+    document = dict(brothers=brothers)
+    if nextAfter is not None:
+        document['next'] = nextAfter
+    return iterJson(document, pretty, compact, fields)
+
+
+# Writes value a piece at a time as jsonify would, with each Brother in it
+# written as the given fields of his serialize() output. An explicit stack
+# stands in for recursion so deep lineages can't hit the recursion limit.
+def iterJson(value, pretty=True, compact=False, fields=TREE_FIELDS):
+    if compact:
+        itemSeparator, keySeparator, indent = ',', ':', None
+    else:
+        itemSeparator, keySeparator = ', ', ': '
+        indent = 2 if pretty else None
+
+    def newline(level):
+        return '\n' + ' ' * (indent * level) if indent else ''
+
+    # One encoder for the whole tree; json.dumps looks up the app and builds
+    # a new one for every value
+    encode = app.json_encoder(ensure_ascii=app.config['JSON_AS_ASCII']).encode
+    keys = {}
+
+    def key(name, level):
+        try:
+            return keys[name, level]
+        except KeyError:
+            keys[name, level] = newline(level) + encode(name) + keySeparator
+            return keys[name, level]
+
+    # Fields in sorted order, as jsonify writes them
+    fields = sorted(fields)
+    chunkSize = app.config['STREAM_CHUNK_SIZE']
+    buf = []
+    size = 0
+    # Brothers read one level at a time know nothing of loops of big
+    # pointers, so anyone already above on the way down is left out. A
+    # TreeStore has none.
+    above = set()
+    stack = [(value, 0)]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, tuple):
+            value, level = item
+            if level is None:
+                # Done with everyone under him
+                above.discard(value.nickname)
+            elif isinstance(value, Brother):
+                if not fields:
+                    stack.append('{}')
+                    continue
+                inner = level + 1
+                stack.append(newline(level) + '}')
+                if not isinstance(value, StoredBrother):
+                    above.add(value.nickname)
+                    stack.append((value, None))
+                for i in xrange(len(fields) - 1, -1, -1):
+                    if fields[i] == 'littles':
+                        stack.append((value.littles, inner))
+                    else:
+                        stack.append(encode(getattr(value, fields[i])))
+                    stack.append((itemSeparator if i else '{') + key(fields[i], inner))
+            elif isinstance(value, list):
+                if above:
+                    value = [little for little in value if not isinstance(little, Brother) or little.nickname not in above]
+                if not value:
+                    stack.append('[]')
+                    continue
+                inner = level + 1
+                stack.append(newline(level) + ']')
+                for i in xrange(len(value) - 1, 0, -1):
+                    stack.append((value[i], inner))
+                    stack.append(itemSeparator + newline(inner))
+                stack.append((value[0], inner))
+                stack.append('[' + newline(inner))
+            elif isinstance(value, dict):
+                if not value:
+                    stack.append('{}')
+                    continue
+                inner = level + 1
+                names = sorted(value)
+                stack.append(newline(level) + '}')
+                for i in xrange(len(names) - 1, -1, -1):
+                    stack.append((value[names[i]], inner))
+                    stack.append((itemSeparator if i else '{') + key(names[i], inner))
+            else:
+                stack.append(encode(value))
         else:
-            optionalFields = optionalFields + (k + ' like ?',)
-            optionalValues = optionalValues + ('%' + default + '%',)
-    requiredQuery = ' AND '.join(requiredFields)
-    requiredQuery = '(' + requiredQuery + ')' if requiredQuery else ''
-    optionalQuery = ' OR '.join(optionalFields)
-    optionalQuery = '(' + optionalQuery + ')' if optionalQuery else ''
-
-    if requiredQuery and optionalQuery:
-        query = 'WHERE {0} AND {1}'.format(requiredQuery, optionalQuery)
+            buf.append(item)
+            size += len(item)
+            if size >= chunkSize:
+                yield ''.join(buf)
+                buf = []
+                size = 0
+    if buf:
+        yield ''.join(buf)
+
+
+# Sends value as jsonify would, Brothers in it with everyone under them, for
+# lineages of any depth
+def jsonifyTree(value):
+    pretty = app.config['JSONIFY_PRETTYPRINT_REGULAR'] and not request.is_xhr
+    with serializing():
+        body = ''.join(iterJson(value, pretty))
+    return Response(body, mimetype='application/json')
+
+
+# Passes the chunks through, keeping the joined result on the snapshot once
+# they have all been sent
+def _keepStreamed(snapshot, name, chunks):
+    parts = []
+    for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+    snapshot.keep(name, ''.join(parts))
+
+
+# Keeps the request context, and with it the request's connection, for as
+# long as the chunks are being sent. Flask's stream_with_context keeps the
+# context pushed when the stream is closed early while DEBUG is on, since it
+# treats the close like an error, so here it is popped however the stream
+# ends.
+def streamWithContext(chunks):
+    def stream(ctx):
+        ctx.push()
+        try:
+            yield None
+            for chunk in chunks:
+                yield chunk
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+            ctx.pop()
+    chunks = iter(chunks)
+    stream = stream(_request_ctx_stack.top)
+    # Started here, so the context is pushed before the request pops its own
+    next(stream)
+    return stream
+
+
+CSV_TYPE = 'text/csv; charset=utf-8'
+
+
+# Yields the export a batch of rows at a time
+def iterExport():
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(['Name', 'Nickname', 'Big', 'Year'])
+    yield buf.getvalue()
+    conn = _get_conn()
+    cur = conn.cursor()
+    # A read transaction keeps the whole export on one snapshot of the table,
+    # even while an import is writing to it
+    with transaction(conn, 'DEFERRED'):
+        cur.execute(BROTHER_ROWS)
+        rows = cur.fetchmany(app.config['EXPORT_BATCH_SIZE'])
+        while rows:
+            buf.seek(0)
+            buf.truncate()
+            for row in rows:
+                writer.writerow([row[1], row[0], row[2], str(row[3])])
+            yield buf.getvalue()
+            rows = cur.fetchmany(app.config['EXPORT_BATCH_SIZE'])
+    cur.close()
+
+
+COMPRESS_WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+
+def compressChunks(chunks, coding):
+    compressor = zlib.compressobj(app.config['COMPRESS_LEVEL'], zlib.DEFLATED, COMPRESS_WBITS[coding])
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def compress(body, coding):
+    return ''.join(compressChunks([body], coding))
+
+
+# gzip or deflate, whichever the client ranks higher (gzip on a tie), or None
+# if it takes neither
+def _contentCoding():
+    return request.accept_encodings.best_match(['gzip', 'deflate'])
+
+
+# A finished body, compressed as the client asks once it's big enough.
+# compressed(coding) can hand back bytes compressed earlier, so cached bodies
+# are only compressed once.
+def compressedResponse(body, mimetype=None, compressed=compress, **kwargs):
+    coding = _contentCoding() if len(body) >= app.config['COMPRESS_MIN_SIZE'] else None
+    if coding is not None:
+        body = compressed(body, coding)
+    response = Response(body, mimetype=mimetype, **kwargs)
+    if coding is not None:
+        response.headers['Content-Encoding'] = coding
+    return response
+
+
+# The same for a body still being written. Enough of it is read up front to
+# tell whether it comes to COMPRESS_MIN_SIZE; if it doesn't it is sent whole.
+# The rest streams, compressed as it goes, and with keep=(snapshot, name) the
+# compressed bytes are kept on the snapshot under name + (coding,). Closing
+# the response closes the chunks too, so a body that is given up on still
+# lets go of its request context and connection straight away.
+def compressedStream(chunks, mimetype=None, keep=None, **kwargs):
+    source = chunks = iter(chunks)
+    head = []
+    size = 0
+    for chunk in chunks:
+        head.append(chunk)
+        size += len(chunk)
+        if size >= app.config['COMPRESS_MIN_SIZE']:
+            break
+    else:
+        return compressedResponse(''.join(head), mimetype, **kwargs)
+    coding = _contentCoding()
+    chunks = chain(head, chunks)
+    if coding is not None:
+        chunks = compressChunks(chunks, coding)
+        if keep is not None:
+            snapshot, name = keep
+            chunks = _keepStreamed(snapshot, name + (coding,), chunks)
+    response = Response(ClosingIterator(chunks, getattr(source, 'close', None)), mimetype=mimetype, **kwargs)
+    if coding is not None:
+        response.headers['Content-Encoding'] = coding
+    return response
+
+
+# Compressed copies of a body kept on the snapshot as name + (coding,)
+def _snapshotCompressed(snapshot, name):
+    return lambda body, coding: snapshot.derive(name + (coding,), lambda snapshot: compress(body, coding))
+
+
+# Turns the words of q, nickname and name into one FTS5 query matching every
+# word as a prefix: q in either column, the others in their own. Returns None
+# if any of them is given without a single word, since nobody can match it.
+def makeMatch(default, nickname, name):
+    terms = []
+    for column, value in [('', default), ('nickname : ', nickname), ('name : ', name)]:
+        words = re.findall(r'\w+', value, re.UNICODE)
+        if value and not words:
+            return None
+        for word in words:
+            terms.append(u'{0}"{1}"*'.format(column, word))
+    return ' AND '.join(terms)
+
+
+# Sort parameters as (column, descending) pairs, each column at most once and
+# nothing after nickname, which is unique. Matches rank best first when
+# nothing else is asked for, and nickname breaks any ties, so every search
+# comes back in one order and pages can follow it. Raises ValueError for
+# anything but the columns of SEARCH_COLUMNS.
+def makeOrder(sort, match):
+    order = []
+    for kind in sort:
+        # An unescaped + arrives as a space
+        kind = kind.strip()
+        column = kind.lstrip('+-')
+        if column not in SEARCH_COLUMNS or len(kind) - len(column) > 1:
+            raise ValueError(kind)
+        if 'nickname' in [earlier for earlier, descending in order]:
+            break
+        if column not in [earlier for earlier, descending in order]:
+            order.append((column, kind.startswith('-')))
+    if match and not order:
+        order.append(('rank', False))
+    if 'nickname' not in [column for column, descending in order]:
+        order.append(('nickname', False))
+    return tuple(order)
+
+
+# Sort columns that are never NULL
+NOT_NULL_COLUMNS = ('nickname', 'rank')
+
+
+def _searchColumn(column):
+    if column == 'rank':
+        return 'brothers_fts.rank'
+    if column == 'big':
+        return 'COALESCE(bigs.nickname, brothers.bigNickname)'
+    return 'brothers.' + column
+
+
+# Builds search statements, keeping each one for reuse. The SQL depends only
+# on which filters are used, the order and whether the cursor's first value is
+# NULL, never on the values themselves, so there are only searchShapes() of
+# them and sqlite's per-connection statement cache (see DB_STATEMENT_CACHE)
+# keeps them all prepared. A hit is a statement the connection running it has
+# prepared already.
+class SearchStatements(object):
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._statements = {}
+        self._lock = threading.Lock()
+
+    def get(self, conn, match, big, year, order, keyset):
+        shape = (bool(match), bool(big), bool(year), order, keyset)
+        with self._lock:
+            cmd = self._statements.get(shape)
+        if cmd is None:
+            cmd = makeSearchQuery(*shape)
+            with self._lock:
+                self._statements[shape] = cmd
+        with self._lock:
+            if cmd in conn.prepared:
+                self.hits += 1
+            else:
+                self.misses += 1
+                conn.prepared.add(cmd)
+        return cmd
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, statements=len(self._statements))
+
+
+# Every shape a search can take: each sort makeOrder accepts, with and without
+# a match, the big and year filters and a cursor
+def searchShapes():
+    kinds = [prefix + column for column in SEARCH_COLUMNS for prefix in ('', '-')]
+    shapes = set()
+    for size in xrange(len(SEARCH_COLUMNS) + 1):
+        for sort in permutations(kinds, size):
+            for match in (False, True):
+                order = makeOrder(sort, 'x' if match else '')
+                keysets = [None, False] if order[0][0] in NOT_NULL_COLUMNS else [None, False, True]
+                for big, year, keyset in product((False, True), (False, True), keysets):
+                    shapes.add((match, big, year, order, keyset))
+    return sorted(shapes)
+
+
+searchStatements = SearchStatements()
+
+
+# The search statement for one shape. Names and nicknames go through the full
+# text index, big and year must match exactly. Values are bound by name:
+# match, big, year, after_<column> for the keyset and limit, which is -1 for
+# no limit. keyset is None without a cursor, otherwise whether the cursor's
+# value for the first sort column is NULL.
+def makeSearchQuery(match, big, year, order, keyset):
+    conditions = []
+    if match:
+        query = 'FROM brothers_fts JOIN brothers ON brothers.id = brothers_fts.rowid ' + BIGS_JOIN
+        conditions.append('brothers_fts MATCH :match')
     else:
-        query = 'WHERE {0}'.format(requiredQuery or optionalQuery)
+        query = 'FROM brothers ' + BIGS_JOIN
+    if big:
+        # A big is either in the table or only known by nickname
+        conditions.append('(brothers.big_id = (SELECT id FROM brothers WHERE nickname = :big) OR brothers.bigNickname = :big)')
+    if year:
+        conditions.append('brothers.year = :year')
+    if keyset is not None:
+        conditions.append(makeKeyset(order, keyset))
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
 
-    if sort:
+    if order:
         orderList = []
-        for kind in sort:
-            direction = 'DESC' if '-' in kind else 'ASC'
-            kind = kind.lstrip('+-')
-            orderList.append('{kind} {direction}'.format(kind=kind, direction=direction))
+        for kind, descending in order:
+            direction = 'DESC' if descending else 'ASC'
+            orderList.append('{kind} {direction}'.format(kind=_searchColumn(kind), direction=direction))
         orderBy = ' ORDER BY {fields}'.format(fields=', '.join(orderList))
         query += orderBy
-    values = requiredValues + optionalValues
-    return values, query
+    return 'SELECT {columns} {query} LIMIT :limit'.format(columns=BROTHER_COLUMNS, query=query)
+
+
+# The condition for rows coming after the cursor in the given order, where
+# :after_<column> holds the sort columns' values for the last row already
+# sent. sqlite sorts NULLs first going up and last going down. The first
+# column is also bounded on its own, so sqlite can seek to the cursor in an
+# index on it rather than scan up to it. That needs a plain comparison, so a
+# NULL in the first column (firstNull) gets a statement of its own; later
+# columns only narrow ties and allow for NULLs either way.
+def makeKeyset(order, firstNull=False):
+    clauses = []
+    for i, (column, descending) in enumerate(order):
+        name = _searchColumn(column)
+        terms = []
+        for j, (earlier, _) in enumerate(order[:i]):
+            if j == 0 and firstNull:
+                terms.append('{0} IS NULL'.format(_searchColumn(earlier)))
+            else:
+                terms.append('{0} IS :after_{1}'.format(_searchColumn(earlier), earlier))
+        if i == 0 and firstNull:
+            if descending:
+                # Nothing comes after a NULL going down
+                continue
+            terms.append('{0} IS NOT NULL'.format(name))
+        elif i == 0 or column in NOT_NULL_COLUMNS:
+            terms.append(_orNull('{0} < :after_{1}', column) if descending else '{0} > :after_{1}'.format(name, column))
+        elif descending:
+            terms.append('({0} < :after_{1} OR ({0} IS NULL AND :after_{1} IS NOT NULL))'.format(name, column))
+        else:
+            terms.append('({0} > :after_{1} OR (:after_{1} IS NULL AND {0} IS NOT NULL))'.format(name, column))
+        clauses.append('(' + ' AND '.join(terms) + ')')
+    keyset = '(' + ' OR '.join(clauses) + ')'
+    first, descending = order[0]
+    if firstNull:
+        return '{0} IS NULL AND {1}'.format(_searchColumn(first), keyset) if descending else keyset
+    if descending:
+        return _orNull('{0} <= :after_{1}', first) + ' AND ' + keyset
+    return '{0} >= :after_{1} AND {2}'.format(_searchColumn(first), first, keyset)
+
+
+# A comparison going down, which also lets through the NULLs that sort after
+# every value unless the column never holds any
+def _orNull(comparison, column):
+    term = comparison.format(_searchColumn(column), column)
+    if column in NOT_NULL_COLUMNS:
+        return term
+    return '({0} OR {1} IS NULL)'.format(term, _searchColumn(column))
+
 
 @app.route('/dpl/search', methods=['GET'])
+@varies('Accept-Encoding')
+@conditional
 def search():
     default = request.args.get('q', '')
     params = dict(
@@ -250,31 +1811,308 @@ def search():
         year = request.args.get('year', '')
     )
     sort = request.args.getlist('sort')
-    values, query = makeSearchQuery(params, default, sort)
+    fields = _fieldsArg(SEARCH_FIELDS, SEARCH_FIELDS)
+    limit = _limitArg()
+    after = request.args.get('after')
+    match = makeMatch(default, params['nickname'], params['name'])
+    try:
+        order = makeOrder(sort, match)
+    except ValueError:
+        abort(400)
+    if match is None:
+        return compressedResponse(jsonify(brothers=[]).get_data(), 'application/json')
+    # One extra row tells whether there's another page
+    values = dict(match=match, big=params['big'], year=params['year'], limit=-1 if limit is None else limit + 1)
     conn = _get_conn()
     cur = conn.cursor()
-    cmd = 'SELECT * FROM brothers {query}'.format(query=query)
+    if after is not None:
+        # Pick up from where the last page's last brother sorts
+        cur.execute(BROTHER_BY_NICKNAME, (after,))
+        row = cur.fetchone()
+        if row is None:
+            if order != (('nickname', False),):
+                abort(400)
+            row = (after, None, None, None)
+        for column, value in zip(SEARCH_COLUMNS, row):
+            values['after_' + column] = value
+        if ('rank', False) in order:
+            cur.execute(MATCH_RANK, (match, after))
+            row = cur.fetchone()
+            if row is None:
+                abort(400)
+            values['after_rank'] = row[0]
+    keyset = None if after is None else values['after_' + order[0][0]] is None
+    cmd = searchStatements.get(conn, match, params['big'], params['year'], order, keyset)
     cur.execute(cmd, values)
     allBrothers = cur.fetchall()
     cur.close()
-    conn.close()
     brothers = []
-    for i in allBrothers:
-        brothers.append(Brother(i[0], i[1], i[2], i[3]).serialize(False))
+    for i in allBrothers[:limit]:
+        brother = Brother(i[0], i[1], i[2], i[3]).serialize(False)
+        brothers.append(dict((field, brother[field]) for field in fields))
     res = {}
     res['brothers'] = brothers
-    return jsonify(res)
+    if limit is not None and len(allBrothers) > limit:
+        res['next'] = allBrothers[limit - 1][0]
+    return compressedResponse(jsonify(res).get_data(), 'application/json')
 
 
 @app.route('/dpl/brothers/', methods=['GET'])
+@varies('Accept', 'Accept-Encoding')
+@conditional
 def readAll():
-    allBrothers = getAllBrothers()
-    brothers = []
-    for bro in allBrothers:
-        brothers.append(Brother(bro[0], bro[1], bro[2], bro[3]).serialize())
-    res = {}
-    res['brothers'] = brothers
-    return jsonify(res)
+    # jsonify only pretty prints for non-XHR requests
+    pretty = app.config['JSONIFY_PRETTYPRINT_REGULAR'] and not request.is_xhr
+    compact = _flagArg('compact')
+    rootsOnly = _flagArg('roots_only')
+    # Roots are sent without littles, so they can't be asked for
+    fields = _fieldsArg(ROOT_FIELDS, ROOT_FIELDS) if rootsOnly else _fieldsArg(TREE_FIELDS, FIELDS)
+    limit = _limitArg()
+    after = request.args.get('after')
+    snapshot = getSnapshot()
+    if _columnarRequested():
+        # The whole tree or nothing, so it can be rebuilt from what's sent
+        if limit is not None or after is not None or rootsOnly or 'fields' in request.args:
+            abort(400)
+        with serializing():
+            body = snapshot.derive(('columnar', pretty, compact),
+                                   lambda snapshot: _columnarJson(columnarTree(snapshot.tree), compact))
+        return compressedResponse(body, COLUMNAR_MIMETYPE, _snapshotCompressed(snapshot, ('columnar', pretty, compact)))
+    if limit is None and after is None and not rootsOnly and fields == TREE_FIELDS:
+        # The body and its compressed copies are kept on the snapshot the
+        # first time they're sent
+        name = ('json', pretty, compact)
+        body = snapshot.derived(name)
+        if body is not None:
+            return compressedResponse(body, 'application/json', _snapshotCompressed(snapshot, name))
+        chunks = serializingChunks(iterTreeJson(snapshot.tree.values(), pretty, compact))
+        return compressedStream(_keepStreamed(snapshot, name, chunks), 'application/json', (snapshot, name))
+    brothers = snapshot.derive('roots', _roots) if rootsOnly else snapshot.tree.values()
+    nextAfter = None
+    if limit is not None or after is not None:
+        # Pages go by nickname, so a cursor still works if its brother has
+        # since been deleted
+        nicknames = snapshot.derive(('nicknames', rootsOnly), lambda snapshot: sorted(bro.nickname for bro in brothers))
+        start = 0 if after is None else bisect_right(nicknames, _toStr(after))
+        end = len(nicknames) if limit is None else start + limit
+        if end < len(nicknames):
+            nextAfter = nicknames[end - 1]
+        brothers = [snapshot.tree[nickname] for nickname in nicknames[start:end]]
+    chunks = serializingChunks(iterTreeJson(brothers, pretty, compact, fields, nextAfter))
+    return compressedStream(streamWithContext(chunks), 'application/json')
+
+
+COLUMNAR_MIMETYPE = 'application/vnd.dpl.columnar+json'
+
+
+# ?format=columnar, or an Accept header preferring the columnar type to plain
+# JSON; any other format is a bad request
+def _columnarRequested():
+    wanted = request.args.get('format')
+    if wanted is not None:
+        if wanted not in ('json', 'columnar'):
+            abort(400)
+        return wanted == 'columnar'
+    return request.accept_mimetypes.best_match(['application/json', COLUMNAR_MIMETYPE]) == COLUMNAR_MIMETYPE
+
+
+# The whole tree with each brother sent once, as parallel columns in pre-order:
+# everyone at the top of a lineage in table order, each followed by his
+# littles in display order. parents gives the position of each brother's big
+# in the same columns, always earlier, or -1 at the top of a lineage, where
+# bigs gives the big's nickname instead (null for the rest).
+def columnarTree(store):
+    size = len(store)
+    order = array('l')
+    positions = array('l', [-1]) * size
+    stack = [i for i in xrange(size - 1, -1, -1) if store.parents[i] < 0]
+    while stack:
+        i = stack.pop()
+        positions[i] = len(order)
+        order.append(i)
+        stack.extend(reversed(store.littlesOf(i)))
+    parents = [positions[store.parents[i]] if store.parents[i] >= 0 else -1 for i in order]
+    return dict(nicknames=[store.nicknames[i] for i in order],
+                names=[store.names[i] for i in order],
+                years=[store.years[i] for i in order],
+                parents=parents,
+                bigs=[store.bigs[i] if parent < 0 else None for i, parent in zip(order, parents)],
+                weights=[store.weights[i] for i in order],
+                activeBranches=[bool(store.active[i]) for i in order])
+
+
+# Laid out as jsonify would, or with no whitespace at all for compact
+def _columnarJson(columns, compact):
+    if compact:
+        return app.json_encoder(ensure_ascii=app.config['JSON_AS_ASCII'], separators=(',', ':'),
+                                sort_keys=True).encode(columns)
+    return jsonify(**columns).get_data()
+
+
+# Brothers at the top of each lineage, table order: those in no big's littles,
+# which takes in one brother of each loop of big pointers as well as those
+# whose big isn't in the tree
+def _roots(snapshot):
+    store = snapshot.tree
+    return [StoredBrother(store, i) for i in xrange(len(store)) if store.parents[i] < 0]
+
+
+# Where each brother goes when the trees under roots are drawn side by side:
+# depth is generations below his root, and his subtree covers span columns
+# starting at slot, one column per brother with no littles. Littles go left
+# to right in display order. One pre-order pass, with each brother's span
+# filled in once everything under him has been placed.
+def layoutTree(roots):
+    layout = []
+    column = 0
+    depth = 0
+    stack = [(bro, 0) for bro in reversed(roots)]
+    while stack:
+        bro, level = stack.pop()
+        if isinstance(bro, dict):
+            bro['span'] = column - bro['slot']
+            continue
+        node = dict(nickname=bro.nickname, depth=level, slot=column)
+        layout.append(node)
+        depth = max(depth, level)
+        littles = bro.littles
+        if littles:
+            stack.append((node, level))
+            stack.extend((little, level + 1) for little in reversed(littles))
+        else:
+            node['span'] = 1
+            column += 1
+    return dict(layout=layout, width=column, depth=depth + 1 if layout else 0)
+
+
+@app.route('/dpl/layout', methods=['GET'])
+@conditional
+def readLayout():
+    pretty = app.config['JSONIFY_PRETTYPRINT_REGULAR'] and not request.is_xhr
+    snapshot = getSnapshot()
+    root = request.args.get('root')
+    if root is None:
+        roots = snapshot.derive('roots', _roots)
+    else:
+        root = _toStr(root)
+        if root not in snapshot.tree:
+            abort(404)
+        roots = [snapshot.tree[root]]
+    # Kept per root, as laid out and as sent
+    with serializing():
+        layout = snapshot.derive(('layout', root), lambda snapshot: layoutTree(roots))
+        body = snapshot.derive(('layout', root, pretty), lambda snapshot: jsonify(**layout).get_data())
+    return Response(body, mimetype='application/json')
+
+
+# Binary lifting tables over a TreeStore, for telling how two brothers are
+# related in O(log n). Brothers go by their position in the store, and the top
+# of each lineage is everyone who isn't anyone's little (so one brother of
+# each loop of big pointers, too). up[k][i] is brother i's big 2**k
+# generations up, or -1 above the top.
+class Lineages(object):
+    def __init__(self, store):
+        self.nicknames = store.nicknames
+        self.index = store.index
+        self.depth = array('l', [0]) * len(store)
+        # Bigs before their littles
+        stack = [i for i, parent in enumerate(store.parents) if parent < 0]
+        while stack:
+            i = stack.pop()
+            for little in store.littlesOf(i):
+                self.depth[little] = self.depth[i] + 1
+                stack.append(little)
+        self.up = [list(store.parents)]
+        for k in xrange(1, max(self.depth or [0]).bit_length()):
+            up = self.up[-1]
+            self.up.append([up[i] if i >= 0 else -1 for i in up])
+
+    def lift(self, i, generations):
+        k = 0
+        while generations:
+            if generations & 1:
+                i = self.up[k][i]
+            generations >>= 1
+            k += 1
+        return i
+
+    # Lowest common ancestor of brothers i and j, or -1 if they are in
+    # different lineages
+    def ancestor(self, i, j):
+        if self.depth[i] < self.depth[j]:
+            i, j = j, i
+        i = self.lift(i, self.depth[i] - self.depth[j])
+        if i == j:
+            return i
+        for up in reversed(self.up):
+            if up[i] != up[j]:
+                i, j = up[i], up[j]
+        return self.up[0][i]
+
+    # Nicknames from brother i up to and including his ancestor
+    def path(self, i, ancestor):
+        path = [self.nicknames[i]]
+        while i != ancestor:
+            i = self.up[0][i]
+            path.append(self.nicknames[i])
+        return path
+
+    # How a is related to b: their lowest common ancestor, the path from each
+    # up to him, how many steps apart they are, and how many generations a is
+    # below b. Everything but the nicknames is null for separate lineages.
+    def relation(self, a, b):
+        i, j = self.index[a], self.index[b]
+        ancestor = self.ancestor(i, j)
+        if ancestor < 0:
+            return dict(a=a, b=b, ancestor=None, aPath=None, bPath=None, distance=None, generations=None)
+        return dict(
+            a=a,
+            b=b,
+            ancestor=self.nicknames[ancestor],
+            aPath=self.path(i, ancestor),
+            bPath=self.path(j, ancestor),
+            distance=self.depth[i] + self.depth[j] - 2 * self.depth[ancestor],
+            generations=self.depth[i] - self.depth[j]
+        )
+
+
+def _lineages(snapshot):
+    return Lineages(snapshot.tree)
+
+
+# Answers every (a, b) pair from the snapshot's lifting tables; an unknown
+# nickname anywhere is a 404
+def _relations(pairs):
+    lineages = getSnapshot().derive('lineages', _lineages)
+    pairs = [(_toStr(a), _toStr(b)) for a, b in pairs]
+    for a, b in pairs:
+        if a not in lineages.index or b not in lineages.index:
+            abort(404)
+    return jsonify(relations=[lineages.relation(a, b) for a, b in pairs])
+
+
+# ?a=<nickname>&b=<nickname>, repeated for more pairs
+@app.route('/dpl/relation', methods=['GET'])
+@conditional
+def readRelation():
+    a = request.args.getlist('a')
+    b = request.args.getlist('b')
+    if not a or len(a) != len(b):
+        abort(400)
+    return _relations(zip(a, b))
+
+
+# {"pairs": [[a, b], ...]}, for more pairs than fit in a URL
+@app.route('/dpl/relation', methods=['POST'])
+def readRelations():
+    req = request.get_json()
+    pairs = req.get('pairs') if isinstance(req, dict) else None
+    if not isinstance(pairs, list) or not pairs:
+        abort(400)
+    for pair in pairs:
+        if not isinstance(pair, list) or len(pair) != 2 or not all(isinstance(nickname, basestring) for nickname in pair):
+            abort(400)
+    return _relations(pairs)
 
 
 @app.route('/dpl/brothers/', methods=['POST'])
@@ -287,8 +2125,9 @@ def create():
     year = req.get('year', '')
     if nickname and name:
         try:
-            brother = Brother(nickname, name, big, year).create()
-            return jsonify(brother.serialize())
+            Brother(nickname, name, big, year).create()
+            # The new snapshot has his whole subtree from one read
+            return jsonifyTree(getSnapshot().tree[_toStr(nickname)])
         except Exception:
             abort(500)
     else:
@@ -301,21 +2140,12 @@ def uploadCsv():
     file = request.files['file']
     ext = os.path.splitext(file.filename)[-1].lower()
     if file is not None and ext == '.csv':
-        errors = []
-        file.stream = StringIO(file.stream.read().decode('latin_1').encode('utf_8'))
-        filestream = csv.DictReader(file)
-        for row in filestream:
-            bro = Brother(row['Nickname'], row['Name'], row['Big'], row['Year'])
-            if Brother(row['Nickname']).read() is None:
-                try:
-                    bro.create()
-                except Exception, e:
-                    errors.append(str(e))
-            else:
-                try:
-                    bro.update()
-                except Exception, e:
-                    errors.append(str(e))
+        # Lines are re-encoded as they are read rather than all up front
+        lines = (line.decode('latin_1').encode('utf_8') for line in file.stream)
+        reader = csv.DictReader(lines)
+        if not set(['Name', 'Nickname', 'Big', 'Year']).issubset(reader.fieldnames or ()):
+            abort(400)
+        errors = importBrothers(reader)
         if errors == []:
             res = 'All rows imported successfully!'
         else:
@@ -329,22 +2159,89 @@ def uploadCsv():
 
 
 @app.route('/dpl/export/', methods=['GET'])
+@varies('Accept-Encoding')
+@conditional
 def downloadCsv():
-    si = StringIO()
-    writer = csv.writer(si)
-    writer.writerow(['Name', 'Nickname', 'Big', 'Year'])
-    for row in getAllBrothers():
-        writer.writerow([row[1], row[0], row[2], str(row[3])])
-    response = make_response(si.getvalue())
+    response = compressedStream(streamWithContext(serializingChunks(iterExport())), content_type=CSV_TYPE)
     response.headers['Content-Disposition'] = 'attachment; filename=brothers.csv'
     return response
 
 
 @app.route('/dpl/brothers/<nickname>', methods=['GET'])
+@conditional
 def readOne(nickname):
+    brother = getSnapshot().tree.get(_toStr(nickname))
+    if brother:
+        return jsonifyTree(brother)
+    else:
+        abort(404)
+
+
+def _lineage(rows):
+    brothers = []
+    for row in rows:
+        obj = Brother(row[0], row[1], row[2], row[3]).serialize(False)
+        obj['depth'] = row[4]
+        brothers.append(obj)
+    return jsonify(brothers=brothers)
+
+
+# Non-negative integer query parameters; anything else is a bad request
+def _intArg(name, default=None):
+    value = request.args.get(name, '')
+    if value == '':
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        abort(400)
+    if value < 0:
+        abort(400)
+    return value
+
+
+def _limitArg():
+    limit = _intArg('limit')
+    if limit == 0:
+        abort(400)
+    return limit
+
+
+def _flagArg(name):
+    return request.args.get(name, '') not in ('', '0', 'false')
+
+
+# ?fields=nickname,name or ?fields=nickname&fields=name, sorted as jsonify
+# would write them
+def _fieldsArg(default, allowed):
+    fields = ','.join(request.args.getlist('fields'))
+    if not fields:
+        return default
+    fields = tuple(sorted(set(fields.split(','))))
+    if not set(fields).issubset(allowed):
+        abort(400)
+    return fields
+
+
+@app.route('/dpl/brothers/<nickname>/ancestors', methods=['GET'])
+@conditional
+def readAncestors(nickname):
     brother = Brother(nickname).read()
     if brother:
-        return jsonify(brother.serialize())
+        return _lineage(brother.getAncestors())
+    else:
+        abort(404)
+
+
+@app.route('/dpl/brothers/<nickname>/descendants', methods=['GET'])
+@conditional
+def readDescendants(nickname):
+    depth = _intArg('depth')
+    limit = _intArg('limit')
+    offset = _intArg('offset', 0)
+    brother = Brother(nickname).read()
+    if brother:
+        return _lineage(brother.getDescendants(depth, limit, offset))
     else:
         abort(404)
 
@@ -366,12 +2263,11 @@ def update(nickname):
                 if name:
                     nickname = newNickname
                 else:
-                    brother.nickname = newNickname
-                    return jsonify(brother.read().serialize())
+                    return jsonifyTree(getSnapshot().tree[_toStr(newNickname)])
         if nickname and name:
             try:
-                brother = Brother(nickname, name, big, year).update()
-                return jsonify(brother.serialize())
+                Brother(nickname, name, big, year).update()
+                return jsonifyTree(getSnapshot().tree[_toStr(nickname)])
             except Exception:
                 abort(500)
         else:
@@ -408,13 +2304,164 @@ def addLittle(nickname):
         try:
             brother.big = nickname
             brother.update()
-            return jsonify(big.read().serialize())
+            return jsonifyTree(getSnapshot().tree[big.nickname])
         except Exception:
             abort(500)
     else:
         abort(404)
 
 
+# Why a batch operation couldn't be applied, and the status to answer with
+class BatchError(Exception):
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+# The brother as he stands so far in the batch's transaction, rather than as
+# any cache has him
+def _batchRow(cur, nickname):
+    cur.execute(BROTHER_BY_NICKNAME, (_toStr(nickname),))
+    row = cur.fetchone()
+    if row is None:
+        raise BatchError(404, 'No brother named {0}'.format(_toStr(nickname)))
+    return row
+
+
+# The named fields must be there as nicknames or names, and big and year,
+# which every operation may leave out, must be a nickname and a number or
+# string if given, so nothing else ever reaches the database
+def _batchRequire(op, *names):
+    for name in names:
+        if not isinstance(op.get(name), basestring) or not op[name]:
+            raise BatchError(400, '{0} needs {1}'.format(op['op'], ', '.join(names)))
+    if not isinstance(op.get('big', ''), basestring):
+        raise BatchError(400, 'big must be a nickname')
+    year = op.get('year', '')
+    if isinstance(year, bool) or not isinstance(year, (basestring, int, long)):
+        raise BatchError(400, 'year must be a number')
+
+
+# Each operation takes the same fields as the endpoint it stands in for and
+# returns the nickname of the brother to report on, if he is still there
+def _batchCreate(cur, op):
+    _batchRequire(op, 'nickname', 'name')
+    cur.execute(BROTHER_EXISTS, (_toStr(op['nickname']),))
+    if cur.fetchone():
+        raise BatchError(409, '{0} already exists'.format(_toStr(op['nickname'])))
+    Brother(op['nickname'], op['name'], op.get('big', ''), op.get('year', ''))._create(cur)
+    return op['nickname']
+
+
+def _batchUpdate(cur, op):
+    _batchRequire(op, 'nickname', 'name')
+    _batchRow(cur, op['nickname'])
+    Brother(op['nickname'], op['name'], op.get('big', ''), op.get('year', ''))._update(cur)
+    return op['nickname']
+
+
+def _batchDelete(cur, op):
+    _batchRequire(op, 'nickname')
+    _batchRow(cur, op['nickname'])
+    Brother(op['nickname'])._delete(cur)
+    return None
+
+
+def _batchRename(cur, op):
+    _batchRequire(op, 'nickname', 'to')
+    _batchRow(cur, op['nickname'])
+    if op['to'] != op['nickname']:
+        cur.execute(BROTHER_EXISTS, (_toStr(op['to']),))
+        if cur.fetchone():
+            raise BatchError(409, '{0} already exists'.format(_toStr(op['to'])))
+        Brother(op['nickname'])._changeNickname(cur, op['to'])
+    return op['to']
+
+
+def _batchAddLittle(cur, op):
+    _batchRequire(op, 'nickname', 'little')
+    big = _batchRow(cur, op['nickname'])
+    little = _batchRow(cur, op['little'])
+    Brother(little[0], little[1], big[0], little[3])._update(cur)
+    return little[0]
+
+
+BATCH_OPERATIONS = {
+    'create': _batchCreate,
+    'update': _batchUpdate,
+    'delete': _batchDelete,
+    'rename': _batchRename,
+    'add-little': _batchAddLittle,
+}
+
+
+# Applies a list of operations in order in one transaction, so either all of
+# them happen or, at the first one that can't, none do. Each result is the
+# brother's own fields as they were right after his operation. ?littles=1 adds
+# his littles and activeBranch, which can only be had once the whole batch is
+# in, so those are as of the end of the batch.
+@app.route('/dpl/batch', methods=['POST'])
+@requires_auth
+def batch():
+    req = request.get_json()
+    operations = req.get('operations') if isinstance(req, dict) else None
+    if not isinstance(operations, list):
+        abort(400)
+    conn = _get_conn()
+    cur = conn.cursor()
+    results = []
+    index = 0
+    try:
+        with transaction(conn):
+            for index, op in enumerate(operations):
+                if not isinstance(op, dict) or not isinstance(op.get('op'), basestring) or \
+                        op['op'] not in BATCH_OPERATIONS:
+                    raise BatchError(400, 'op must be one of {0}'.format(', '.join(sorted(BATCH_OPERATIONS))))
+                nickname = BATCH_OPERATIONS[op['op']](cur, op)
+                result = dict(op=op['op'])
+                if nickname is None:
+                    result['nickname'] = _toStr(op['nickname'])
+                else:
+                    result.update(zip(('nickname', 'name', 'big', 'year'), _batchRow(cur, nickname)))
+                results.append(result)
+    except BatchError, e:
+        response = jsonify(error=str(e), index=index)
+        response.status_code = e.status
+        return response
+    except sqlite3.Error:
+        # Anything else is a bug, and goes up with its traceback as it is
+        app.logger.exception('Batch failed at operation {0:d}'.format(index))
+        abort(500)
+    finally:
+        cur.close()
+    _written()
+    if _flagArg('littles'):
+        tree = getSnapshot().tree
+        for result in results:
+            # Anyone deleted later in the batch only has his own fields
+            if result['op'] != 'delete' and result['nickname'] in tree:
+                brother = tree[result['nickname']]
+                result.update(littles=brother.littles, activeBranch=brother.activeBranch)
+    return jsonifyTree(dict(results=results))
+
+
+# Totals across every worker since the metrics database was created, in the
+# Prometheus text format
+@app.route('/dpl/metrics', methods=['GET'])
+def readMetrics():
+    if not app.config['METRICS']:
+        abort(404)
+    lines = []
+    name = None
+    for metric, endpoint, value in metricsStore.read():
+        if metric != name:
+            name = metric
+            lines.append('# HELP dpl_{0}_total {1}'.format(metric, METRIC_HELP.get(metric, metric)))
+            lines.append('# TYPE dpl_{0}_total counter'.format(metric))
+        lines.append('dpl_{0}_total{{endpoint="{1}"}} {2!r}'.format(metric, endpoint, value))
+    return Response('\n'.join(lines) + '\n', content_type=PROMETHEUS_TYPE)
+
+
 def check_auth(username, password):
     return username == app.config['USERNAME'] and password == app.config['PASSWORD']
 
@@ -428,7 +2475,10 @@ def authenticate():
 @app.after_request
 def after_request(response):
     response.headers.add('Access-Control-Allow-Origin', '*')
-    if response.headers['Content-Type'] != 'text/html':
+    # A 304 has no body, so it gets no Content-Type either
+    if response.status_code == 304:
+        response.headers.pop('Content-Type', None)
+    elif response.headers.get('Content-Type') not in ('text/html', CSV_TYPE, PROMETHEUS_TYPE, COLUMNAR_MIMETYPE):
         response.headers['Content-Type'] = 'text/json'
     response.headers['Access-Control-Allow-Methods'] = 'POST, GET, PUT, DELETE'
     response.headers['Access-Control-Allow-Headers'] = 'Origin, X-Requested-With,Content-Type, Accept, Authorization'
@@ -0,0 +1,544 @@
+#!/usr/bin/python
+# Benchmarks for dpl.py
+#
+#   python dpl_bench.py sort        times Brother.sortLittles for 10, 100 and
+#                                   10,000 siblings
+#   python dpl_bench.py generate    writes a synthetic tree to a database
+#   python dpl_bench.py endpoints   times every endpoint through the Flask
+#                                   test client on synthetic trees
+#   python dpl_bench.py serve       drives a local gunicorn, configured by
+#                                   gunicorn.config.py, with concurrent clients
+#   python dpl_bench.py compare     compares two saved runs and flags
+#                                   regressions
+#   python dpl_bench.py memory      measures what holding a synthetic tree
+#                                   in memory costs
+#
+# endpoints and serve take --json to save their results for compare.
+import gc
+import os
+import sys
+import json
+import time
+import random
+import socket
+import sqlite3
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import timeit
+import urllib2
+from base64 import b64encode
+from collections import OrderedDict
+from datetime import date, datetime
+from StringIO import StringIO
+import dpl
+
+SHAPES = ('chain', 'fanout', 'mixed')
+BATCH_SIZE = 10
+WORDS = ['Andrew', 'Kyle', 'Michael', 'Cory', 'Sebastian', 'Jeremy', 'Smith', 'Halstead', 'Higgins',
+         'Lauer', 'Espinosa', 'Filteau', 'Vapor', 'Karu', 'Sanctus', 'Turtle', 'Agent', 'Dish']
+
+
+def makeSiblings(count, rand):
+    # Weight comes from the number of littles, so sharing one leaf keeps
+    # big sibling sets cheap to build
+    leaf = dpl.Brother('leaf', littles=[])
+    siblings = []
+    for i in xrange(count):
+        siblings.append(dpl.Brother('little{0}'.format(i), littles=[leaf] * rand.randint(0, 20)))
+    for sibling in siblings:
+        sibling.weight
+    return siblings
+
+
+def benchSort(args):
+    rand = random.Random(args.seed)
+    for count in args.siblings:
+        siblings = makeSiblings(count, rand)
+        timer = timeit.Timer(lambda: dpl.Brother.sortLittles(siblings))
+        number, total = 1, 0
+        # Enough calls to take at least a fifth of a second
+        while True:
+            total = min(timer.repeat(args.repeat, number))
+            if total >= 0.2:
+                break
+            number *= 10
+        print 'sortLittles {0:>6} siblings: {1:10.2f} us per call'.format(count, total / number * 1e6)
+
+
+# Rows of (nickname, name, big, year) for a tree of the given shape:
+#   chain   everyone is the only little of the one before
+#   fanout  every brother has up to fanout littles, filled in breadth first
+#   mixed   something like a real chapter: a pledge class a year for 44
+#           years, bigs from the class or two above, some with far more
+#           littles than others, and a few bigs who aren't in the table
+def generateRows(shape, size, rand, fanout=10):
+    rows = []
+    thisYear = date.today().year
+    firstYear = thisYear - 40
+    classStarts = {}
+    for i in xrange(size):
+        nickname = 'b{0}'.format(i)
+        name = '{0} {1}'.format(rand.choice(WORDS), rand.choice(WORDS))
+        if shape == 'chain':
+            big = 'b{0}'.format(i - 1) if i else ''
+            year = thisYear - size + i + 4
+        elif shape == 'fanout':
+            big = 'b{0}'.format((i - 1) // fanout) if i else ''
+            year = rand.randint(firstYear, thisYear + 4)
+        else:
+            year = firstYear + i * 44 // size
+            classStarts.setdefault(year, i)
+            first = classStarts.get(year - 2, classStarts.get(year - 1))
+            if first is None or rand.random() < 0.002:
+                big = rand.choice(['', 'Alumnus'])
+            else:
+                # Squaring favours the front of the range, so some bigs
+                # end up with many littles and others with none
+                big = rows[first + int((classStarts[year] - first) * rand.random() ** 2)][0]
+        rows.append((nickname, name, big, year))
+    return rows
+
+
+# A fresh database at path holding the rows, with its stored aggregates
+# worked out
+def writeTree(path, rows):
+    dpl.app.config['DATABASE'] = path
+    dpl.pool.clear()
+    dpl.init_db()
+    conn = sqlite3.connect(path)
+    conn.executemany('INSERT INTO brothers (nickname, name, bigNickname, year) VALUES (?, ?, ?, ?)', rows)
+    conn.commit()
+    conn.close()
+    dpl.verify_db(rebuild=True)
+
+
+def benchGenerate(args):
+    rand = random.Random(args.seed)
+    rows = generateRows(args.shape, args.size, rand, args.fanout)
+    if os.path.exists(args.out):
+        sys.exit('{0} already exists'.format(args.out))
+    writeTree(args.out, rows)
+    print 'Wrote {0:d} brothers to {1}'.format(len(rows), args.out)
+
+
+def _meta(args):
+    return dict(
+        command=' '.join(sys.argv[1:]),
+        started=datetime.utcnow().isoformat() + 'Z',
+        python=platform.python_version(),
+        sqlite=sqlite3.sqlite_version,
+        host=socket.gethostname(),
+        seed=args.seed
+    )
+
+
+def _save(args, results):
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(meta=_meta(args), results=results), f, indent=2, sort_keys=True)
+        print 'Saved results to {0}'.format(args.json)
+
+
+# Nicknames worth asking for: the first root, a brother halfway down the
+# longest line and the last brother added
+def _samples(tree):
+    root = tree.values()[0]
+    deepest = max(tree.itervalues(), key=lambda bro: 0 if bro.big in tree else bro.weight)
+    line = [deepest]
+    while line[-1].littles and len(line) < 10000:
+        line.append(max(line[-1].littles, key=lambda bro: bro.weight))
+    return root.nickname, line[len(line) // 2].nickname, tree.keys()[-1]
+
+
+# Every endpoint, as (label, method, path, body) with path and body built from
+# the sample nicknames and the iteration number, so writes never collide
+def _cases(root, middle, leaf, fullTree):
+    cases = []
+    if fullTree:
+        cases.append(('GET /dpl/brothers/ (cold)', 'get', '/dpl/brothers/', None))
+        cases.append(('GET /dpl/brothers/', 'get', '/dpl/brothers/', None))
+        cases.append(('GET /dpl/brothers/?compact=1', 'get', '/dpl/brothers/?compact=1', None))
+    cases.extend([
+        ('GET /dpl/brothers/?roots_only=1', 'get', '/dpl/brothers/?roots_only=1', None),
+        ('GET /dpl/brothers/?limit=100', 'get', '/dpl/brothers/?limit=100&fields=nickname,weight', None),
+        ('GET /dpl/brothers/<root>', 'get', '/dpl/brothers/' + root, None),
+        ('GET /dpl/brothers/<middle>', 'get', '/dpl/brothers/' + middle, None),
+        ('GET /dpl/brothers/<leaf>/ancestors', 'get', '/dpl/brothers/{0}/ancestors'.format(leaf), None),
+        ('GET /dpl/brothers/<root>/descendants?limit=100', 'get',
+         '/dpl/brothers/{0}/descendants?limit=100'.format(root), None),
+        ('GET /dpl/search?q=', 'get', '/dpl/search?q=kar', None),
+        ('GET /dpl/search?q=&limit=20', 'get', '/dpl/search?q=kar&limit=20', None),
+        ('GET /dpl/search?year=', 'get', '/dpl/search?year={0}'.format(date.today().year), None),
+        ('GET /dpl/export/', 'get', '/dpl/export/', None),
+        ('GET /dpl/brothers/?format=columnar', 'get', '/dpl/brothers/?format=columnar', None),
+        ('GET /dpl/layout', 'get', '/dpl/layout', None),
+        ('GET /dpl/relation?a=<leaf>&b=<middle>', 'get', '/dpl/relation?a={0}&b={1}'.format(leaf, middle), None),
+        ('POST /dpl/brothers/', 'post', '/dpl/brothers/',
+         lambda i: dict(nickname='bench{0}'.format(i), name='Bench Mark', big=middle, year=2014)),
+        ('PUT /dpl/brothers/<new>', 'put', lambda i: '/dpl/brothers/bench{0}'.format(i),
+         lambda i: dict(name='Bench Marked', big=leaf, year=2015)),
+        ('PUT /dpl/add-little/<root>', 'put', '/dpl/add-little/' + root,
+         lambda i: dict(little='bench{0}'.format(i))),
+        ('DELETE /dpl/brothers/<new>', 'delete', lambda i: '/dpl/brothers/bench{0}'.format(i), None),
+        ('POST /dpl/batch ({0} creates, {0} deletes)'.format(BATCH_SIZE), 'post', '/dpl/batch',
+         lambda i: dict(operations=_batchOperations(middle, i))),
+        ('POST /dpl/import/ (100 rows)', 'import', '/dpl/import/', None),
+    ])
+    return cases
+
+
+# BATCH_SIZE new littles of big, then each of them deleted again, so the
+# database ends the batch as it started it
+def _batchOperations(big, i):
+    nicknames = ['batch{0}-{1}'.format(i, j) for j in xrange(BATCH_SIZE)]
+    creates = [dict(op='create', nickname=nickname, name='Bench Mark', big=big, year=2014) for nickname in nicknames]
+    deletes = [dict(op='delete', nickname=nickname) for nickname in nicknames]
+    return creates + deletes
+
+
+def _importFile(rows, i):
+    out = StringIO()
+    out.write('Name,Nickname,Big,Year\n')
+    for nickname, name, big, year in rows[:100]:
+        out.write('{0},{1},{2},{3}\n'.format(name, nickname, big, 2000 + i))
+    out.seek(0)
+    return dict(file=(out, 'bench.csv'))
+
+
+def _timeCase(client, rows, case, repeat):
+    label, method, path, body = case
+    auth = {'Authorization': 'Basic ' + b64encode('{0}:{1}'.format(dpl.app.config['USERNAME'],
+                                                                   dpl.app.config['PASSWORD']))}
+    times = []
+    status = None
+    for i in xrange(repeat):
+        if label.endswith('(cold)'):
+            dpl.invalidateSnapshot()
+        url = path(i) if callable(path) else path
+        send = getattr(client, 'post' if method == 'import' else method)
+        kwargs = dict(headers=auth)
+        if method == 'import':
+            kwargs['data'] = _importFile(rows, i)
+            kwargs['content_type'] = 'multipart/form-data'
+        elif body is not None:
+            kwargs['data'] = json.dumps(body(i))
+            kwargs['content_type'] = 'application/json'
+        start = time.time()
+        try:
+            response = send(url, **kwargs)
+            size = len(response.data)
+            status = response.status_code
+        except Exception, e:
+            return dict(error='{0}: {1}'.format(type(e).__name__, e))
+        times.append(time.time() - start)
+    times.sort()
+    return dict(min=times[0], median=times[len(times) // 2], runs=len(times), status=status, bytes=size)
+
+
+def benchEndpoints(args):
+    results = {}
+    for shape in args.shapes:
+        for size in args.sizes:
+            rand = random.Random(args.seed)
+            rows = generateRows(shape, size, rand, args.fanout)
+            fd, path = tempfile.mkstemp(suffix='.db')
+            os.close(fd)
+            os.unlink(path)
+            try:
+                writeTree(path, rows)
+                with dpl.app.test_request_context():
+                    tree = dpl.getTree()
+                    samples = _samples(tree)
+                    # Every brother is written out once for each brother above
+                    # him, which gets out of hand for deep trees
+                    nodes = sum(bro.weight for bro in tree.itervalues())
+                    del tree
+                fullTree = nodes <= args.max_nodes
+                client = dpl.app.test_client()
+                key = '{0}-{1:d}'.format(shape, size)
+                results[key] = {}
+                print '{0} ({1:d} nodes in the full tree{2})'.format(
+                    key, nodes, '' if fullTree else ', too many to fetch it whole')
+                for case in _cases(samples[0], samples[1], samples[2], fullTree):
+                    result = _timeCase(client, rows, case, args.repeat)
+                    results[key][case[0]] = result
+                    if 'error' in result:
+                        print '  {0:<50} {1}'.format(case[0], result['error'])
+                    else:
+                        print '  {0:<50} {1:10.2f} ms  (min {2:.2f}, status {3:d})'.format(
+                            case[0], result['median'] * 1000, result['min'] * 1000, result['status'])
+            finally:
+                dpl.pool.clear()
+                dpl.invalidateSnapshot()
+                for suffix in ['', '-wal', '-shm']:
+                    if os.path.exists(path + suffix):
+                        os.unlink(path + suffix)
+    _save(args, results)
+
+
+def _waitForServer(url, process, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            sys.exit('gunicorn exited with status {0:d}'.format(process.returncode))
+        try:
+            urllib2.urlopen(url, timeout=1).read()
+            return
+        except (urllib2.URLError, socket.error):
+            time.sleep(0.2)
+    sys.exit('gunicorn did not start within {0:d} seconds'.format(timeout))
+
+
+def _client(base, paths, deadline, latencies, errors, lock):
+    mine = []
+    failed = 0
+    i = 0
+    while time.time() < deadline:
+        path = paths[i % len(paths)]
+        i += 1
+        start = time.time()
+        try:
+            urllib2.urlopen(base + path, timeout=60).read()
+            mine.append(time.time() - start)
+        except (urllib2.URLError, socket.error):
+            failed += 1
+    with lock:
+        latencies.extend(mine)
+        errors.append(failed)
+
+
+def _percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def benchServe(args):
+    rand = random.Random(args.seed)
+    rows = generateRows(args.shape, args.size, rand, args.fanout)
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    os.unlink(path)
+    writeTree(path, rows)
+    dpl.pool.clear()
+    root, leaf = rows[0][0], rows[-1][0]
+    paths = args.paths or [
+        '/dpl/brothers/?roots_only=1',
+        '/dpl/brothers/' + leaf,
+        '/dpl/brothers/{0}/ancestors'.format(leaf),
+        '/dpl/brothers/{0}/descendants?limit=100'.format(root),
+        '/dpl/search?q=kar&limit=20',
+        '/dpl/brothers/?limit=100&fields=nickname,weight',
+    ]
+    here = os.path.dirname(os.path.abspath(__file__))
+    command = args.gunicorn.split() + ['-c', os.path.join(here, 'gunicorn.config.py'), 'dpl:app']
+    if args.workers:
+        command[-1:-1] = ['-w', str(args.workers)]
+    env = dict(os.environ, DB_PATH=path, PORT=str(args.port))
+    process = subprocess.Popen(command, cwd=here, env=env)
+    base = 'http://127.0.0.1:{0:d}'.format(args.port)
+    try:
+        _waitForServer(base + paths[0], process)
+        latencies, errors, lock = [], [], threading.Lock()
+        deadline = time.time() + args.duration
+        clients = [threading.Thread(target=_client, args=(base, paths[i:] + paths[:i], deadline, latencies, errors, lock))
+                   for i in xrange(args.clients)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+    finally:
+        process.terminate()
+        process.wait()
+        for suffix in ['', '-wal', '-shm', '.metrics', '.metrics-wal', '.metrics-shm']:
+            if os.path.exists(path + suffix):
+                os.unlink(path + suffix)
+    latencies.sort()
+    if not latencies:
+        sys.exit('No requests succeeded')
+    result = dict(
+        requests=len(latencies),
+        errors=sum(errors),
+        rps=len(latencies) / float(args.duration),
+        median=_percentile(latencies, 0.5),
+        p90=_percentile(latencies, 0.9),
+        p99=_percentile(latencies, 0.99),
+        clients=args.clients,
+        paths=paths
+    )
+    print '{0:d} requests ({1:d} errors) from {2:d} clients in {3:d}s: {4:.1f}/s'.format(
+        result['requests'], result['errors'], args.clients, args.duration, result['rps'])
+    print 'latency median {0:.2f} ms, p90 {1:.2f} ms, p99 {2:.2f} ms'.format(
+        result['median'] * 1000, result['p90'] * 1000, result['p99'] * 1000)
+    key = 'serve {0}-{1:d}'.format(args.shape, args.size)
+    _save(args, {key: {'GET mix': result}})
+
+
+# Compares the medians of two saved runs. Anything slower by more than the
+# threshold, and by more than the noise floor, is a regression, and makes the
+# exit status 1.
+def benchCompare(args):
+    with open(args.old) as f:
+        old = json.load(f)['results']
+    with open(args.new) as f:
+        new = json.load(f)['results']
+    regressions = 0
+    for key in sorted(set(old) & set(new)):
+        print key
+        for label in sorted(set(old[key]) & set(new[key])):
+            before, after = old[key][label], new[key][label]
+            if 'median' not in before or 'median' not in after:
+                print '  {0:<50} {1}'.format(label, after.get('error') or before.get('error'))
+                continue
+            change = (after['median'] - before['median']) / before['median'] if before['median'] else 0
+            flag = ''
+            if change > args.threshold and after['median'] - before['median'] > args.floor / 1000.0:
+                flag = '  REGRESSION'
+                regressions += 1
+            print '  {0:<50} {1:10.2f} -> {2:10.2f} ms  {3:+7.1%}{4}'.format(
+                label, before['median'] * 1000, after['median'] * 1000, change, flag)
+    print '{0:d} regression{1}'.format(regressions, '' if regressions == 1 else 's')
+    if regressions:
+        sys.exit(1)
+
+
+# A Brother as he was held before TreeStore and __slots__: the same attributes
+# in a __dict__ each, worked out by the same pass
+class DictBrother(object):
+    aggregate = dpl.Brother.aggregate.__func__
+    _loadedLittles = dpl.Brother._loadedLittles.__func__
+    _aggregates = dpl.Brother._aggregates.__func__
+    _setAggregates = dpl.Brother._setAggregates.__func__
+
+    def __init__(self, row):
+        self.nickname, self.name, self.big, self.year = row[:4]
+        self._littles = []
+        self._weight = None
+        self._maxYear = None
+        self._activeBranch = None
+
+    @property
+    def weight(self):
+        return self._weight
+
+
+# The tree as buildTree used to make it, out of brothers of the given class
+def _objectTree(rows, make):
+    tree = OrderedDict()
+    for row in rows:
+        tree[row[0]] = make(row)
+    for bro in tree.itervalues():
+        big = tree.get(bro.big)
+        if big is not None:
+            big._littles.append(bro)
+    currentYear = date.today().year
+    for bro in tree.itervalues():
+        bro.aggregate(currentYear)
+    return tree
+
+
+TREES = [
+    ('Brothers with a __dict__', lambda rows: _objectTree(rows, DictBrother)),
+    ('Brothers with __slots__', lambda rows: _objectTree(rows, lambda row: dpl.Brother(*row[:4], littles=[]))),
+    ('TreeStore', dpl.buildTree),
+]
+
+
+# Resident memory of this process in bytes (Linux only)
+def _rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+# How much more memory a forked child holds once it has built the tree, so
+# each way of holding it starts from the same rows in a clean process
+def _treeMemory(rows, build):
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        gc.collect()
+        before = _rss()
+        with dpl.app.test_request_context():
+            tree = build(rows)
+        gc.collect()
+        os.write(write, str(_rss() - before))
+        os._exit(0)
+    os.close(write)
+    used = int(os.read(read, 64))
+    os.close(read)
+    os.waitpid(pid, 0)
+    return used
+
+
+def benchMemory(args):
+    for size in args.sizes:
+        rows = generateRows(args.shape, size, random.Random(args.seed), args.fanout)
+        print '{0}-{1:d}'.format(args.shape, size)
+        baseline = None
+        for label, build in TREES:
+            used = _treeMemory(rows, build)
+            if baseline is None:
+                baseline = used
+            print '  {0:<26} {1:8.1f} MB  {2:6.0f} bytes each  {3:6.1%} of the first'.format(
+                label, used / 1e6, float(used) / size, float(used) / baseline)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for dpl.py')
+    parser.add_argument('--seed', type=int, default=2014)
+    commands = parser.add_subparsers()
+    sort = commands.add_parser('sort', help='time Brother.sortLittles')
+    sort.add_argument('--siblings', type=int, nargs='+', default=[10, 100, 10000])
+    sort.add_argument('--repeat', type=int, default=3)
+    sort.set_defaults(run=benchSort)
+
+    generate = commands.add_parser('generate', help='write a synthetic tree to a new database')
+    generate.add_argument('out')
+    generate.add_argument('--shape', choices=SHAPES, default='mixed')
+    generate.add_argument('--size', type=int, default=10000)
+    generate.add_argument('--fanout', type=int, default=10)
+    generate.set_defaults(run=benchGenerate)
+
+    endpoints = commands.add_parser('endpoints', help='time every endpoint through the test client')
+    endpoints.add_argument('--shapes', choices=SHAPES, nargs='+', default=list(SHAPES))
+    endpoints.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    endpoints.add_argument('--fanout', type=int, default=10)
+    endpoints.add_argument('--repeat', type=int, default=5)
+    endpoints.add_argument('--max-nodes', type=int, default=2000000,
+                           help='skip fetching the whole tree when it would hold more nodes than this')
+    endpoints.add_argument('--json', help='save the results here')
+    endpoints.set_defaults(run=benchEndpoints)
+
+    serve = commands.add_parser('serve', help='drive a local gunicorn with concurrent clients')
+    serve.add_argument('--shape', choices=SHAPES, default='mixed')
+    serve.add_argument('--size', type=int, default=10000)
+    serve.add_argument('--fanout', type=int, default=10)
+    serve.add_argument('--clients', type=int, default=8)
+    serve.add_argument('--duration', type=int, default=10)
+    serve.add_argument('--port', type=int, default=8052)
+    serve.add_argument('--workers', type=int, help='overrides the worker count in gunicorn.config.py')
+    serve.add_argument('--gunicorn', default='gunicorn', help='command that starts gunicorn')
+    serve.add_argument('--paths', nargs='+', help='paths to request in turn instead of the default mix')
+    serve.add_argument('--json', help='save the results here')
+    serve.set_defaults(run=benchServe)
+
+    compare = commands.add_parser('compare', help='compare two saved runs')
+    compare.add_argument('old')
+    compare.add_argument('new')
+    compare.add_argument('--threshold', type=float, default=0.1, help='slowdown that counts as a regression')
+    compare.add_argument('--floor', type=float, default=1.0, help='ignore slowdowns smaller than this many ms')
+    compare.set_defaults(run=benchCompare)
+
+    memory = commands.add_parser('memory', help='measure the memory a built tree holds')
+    memory.add_argument('--shape', choices=SHAPES, default='mixed')
+    memory.add_argument('--sizes', type=int, nargs='+', default=[10000, 50000])
+    memory.add_argument('--fanout', type=int, default=10)
+    memory.set_defaults(run=benchMemory)
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
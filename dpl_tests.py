@@ -1,13 +1,21 @@
+import gc
 import os
 import dpl
+import sqlite3
 import unittest
 import tempfile
 import json
+import random
+import time
+import zlib
+import logging
 from datetime import date
 from werkzeug.datastructures import Headers
+from werkzeug.http import http_date
 from base64 import b64encode
 from StringIO import StringIO
 from copy import deepcopy
+from gzip import GzipFile
 
 Vaporizer = dict(
     name='Andrew Smith',
@@ -46,6 +54,45 @@ DoubleAgent = dict(
     year=2013
 )
 
+class Weighted(object):
+    def __init__(self, weight):
+        self.weight = weight
+
+    __lt__ = dpl.Brother.__lt__.__func__
+
+
+# The original quadratic ordering that Brother.sortLittles must still match
+def sortLittlesByPopping(littles):
+    res = []
+    littles.sort()
+    if len(littles) % 2:
+        res.append(littles.pop(0))
+    while len(littles):
+        res.insert(0, littles.pop(0))
+        res.append(littles.pop(0))
+        if len(littles):
+            res.insert(0, littles.pop())
+            res.append(littles.pop())
+    return res
+
+
+class CountingCursor(sqlite3.Cursor):
+    queries = 0
+
+    def execute(self, *args):
+        CountingCursor.queries += 1
+        return sqlite3.Cursor.execute(self, *args)
+
+    def executemany(self, *args):
+        CountingCursor.queries += 1
+        return sqlite3.Cursor.executemany(self, *args)
+
+
+class CountingConnection(dpl.PooledConnection):
+    def cursor(self, factory=CountingCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+
 class DplTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -56,10 +103,30 @@ class DplTestCase(unittest.TestCase):
         dpl.app.config['PASSWORD'] = 'password'
         self.app = dpl.app.test_client()
         self.auth = {'Authorization': 'Basic ' + b64encode('admin:password')}
+        self._get_conn = dpl._get_conn
         dpl.init_db()
 
     def tearDown(self):
+        dpl.pool.clear()
         os.unlink(dpl.app.config['DATABASE'])
+        dpl._get_conn = self._get_conn
+
+    def setRevisionModified(self, modified):
+        conn = sqlite3.connect(dpl.app.config['DATABASE'])
+        conn.execute('UPDATE revision SET modified = ?', (int(modified),))
+        conn.commit()
+        conn.close()
+
+    def countQueries(self, method, *args, **kwargs):
+        def _get_conn():
+            conn = sqlite3.connect(dpl.app.config['DATABASE'], factory=CountingConnection)
+            conn.text_factory = str
+            return conn
+        self._get_conn, dpl._get_conn = dpl._get_conn, _get_conn
+        CountingCursor.queries = 0
+        response = method(*args, **kwargs)
+        dpl._get_conn = self._get_conn
+        return response, CountingCursor.queries
 
     def test_empty_db(self):
         response = self.app.get('/dpl/brothers/')
@@ -369,6 +436,864 @@ class DplTestCase(unittest.TestCase):
         expected['littles'] = [expKaru, expDishficks, expDoubleAgent]
         assert json.loads(response.data) == expected
 
+    def test_big_cycle(self):
+        # Two brothers listed as each other's big must not hang the tree
+        self.app.post(
+            '/dpl/brothers/',
+            data=json.dumps(Vaporizer),
+            content_type='application/json',
+            headers=self.auth
+        )
+        self.app.post(
+            '/dpl/brothers/',
+            data=json.dumps(Karu),
+            content_type='application/json',
+            headers=self.auth
+        )
+        self.app.put(
+            '/dpl/add-little/Karu',
+            data=json.dumps(dict(little='Vaporizer')),
+            content_type='application/json',
+            headers=self.auth
+        )
+        response = self.app.get('/dpl/brothers/')
+        assert response.status_code == 200
+        brothers = json.loads(response.data)['brothers']
+        assert [bro['nickname'] for bro in brothers] == ['Vaporizer', 'Karu']
+        assert brothers[0]['littles'][0]['nickname'] == 'Karu'
+        assert brothers[0]['littles'][0]['littles'] == []
+        response = self.app.get('/dpl/brothers/Karu')
+        assert response.status_code == 200
+        # Nor the brothers written back, which are read a level at a time
+        response = self.app.put(
+            '/dpl/brothers/Karu',
+            data=json.dumps(Karu),
+            content_type='application/json',
+            headers=self.auth
+        )
+        assert response.status_code == 200
+        # Answered from the tree, where the loop is cut above him
+        assert json.loads(response.data)['littles'] == []
+        response = self.app.post(
+            '/dpl/brothers/',
+            data=json.dumps(dict(Sanctus, big='Sanctus')),
+            content_type='application/json',
+            headers=self.auth
+        )
+        assert response.status_code == 200
+
+    def test_queries_per_endpoint(self):
+        for bro in [Vaporizer, Karu, Sanctus, DoubleAgent]:
+            self.app.post(
+                '/dpl/brothers/',
+                data=json.dumps(bro),
+                content_type='application/json',
+                headers=self.auth
+            )
+        # The revision stamp, then the table itself, in a worker that didn't
+        # make the writes
+        dpl.invalidateSnapshot()
+        response, queries = self.countQueries(self.app.get, '/dpl/brothers/')
+        assert response.status_code == 200
+        assert queries == 2
+        # Only the revision stamp while the cached tree is current
+        response, queries = self.countQueries(self.app.get, '/dpl/brothers/')
+        assert response.status_code == 200
+        assert queries == 1
+        response, queries = self.countQueries(self.app.get, '/dpl/brothers/Vaporizer')
+        assert response.status_code == 200
+        assert queries == 1
+        # The revision stamp for the ETag, then the search itself
+        response, queries = self.countQueries(self.app.get, '/dpl/search?q=Vapor')
+        assert response.status_code == 200
+        assert queries == 2
+        # Existence checks no longer load the subtree. read, then in one
+        # transaction his big, his littles let go, the delete, then his big's
+        # id and aggregates
+        response, queries = self.countQueries(
+            self.app.delete,
+            '/dpl/brothers/Double Agent',
+            headers=self.auth
+        )
+        assert response.status_code == 200
+        assert queries == 10
+        # read, then in one transaction his big, his big's id, update and
+        # aggregates for him and his unchanged big, then the revision stamp
+        # and the table for the rebuilt tree, however big his subtree
+        response, queries = self.countQueries(
+            self.app.put,
+            '/dpl/brothers/Karu',
+            data=json.dumps(Karu),
+            content_type='application/json',
+            headers=self.auth
+        )
+        assert response.status_code == 200
+        assert queries == 14
+        # big, little, then in one transaction his old big, the new big's id,
+        # update and aggregates up both bigs' paths, and the rebuilt tree
+        response, queries = self.countQueries(
+            self.app.put,
+            '/dpl/add-little/Vaporizer',
+            data=json.dumps(dict(little='Sanctus')),
+            content_type='application/json',
+            headers=self.auth
+        )
+        assert response.status_code == 200
+        assert queries == 15
+        csvString = 'Name,Nickname,Big,Year\nAndrew Smith,Vaporizer,McLovin\',2014\nCory Lauer,Double Agent,Vaporizer,2013'
+        # One upsert for the whole batch, wrapped in a transaction and
+        # savepoint, then linking up bigs and one read and one write to redo
+        # the aggregates
+        response, queries = self.countQueries(
+            self.app.post,
+            '/dpl/import/',
+            data=dict(file=(StringIO(csvString), 'upload.csv')),
+            content_type='multipart/form-data',
+            headers=self.auth
+        )
+        assert response.data == 'All rows imported successfully!'
+        assert queries == 8
+
+    def test_write_locks_before_reading_bigs(self):
+        # Another worker creating the big between the lookup and the insert
+        # would leave Karu naming him without pointing at him
+        blocked = []
+        original = dpl._bigColumns
+
+        def racingBigColumns(cur, big):
+            other = sqlite3.connect(dpl.app.config['DATABASE'], timeout=0)
+            try:
+                other.execute('INSERT INTO brothers (nickname, name, year) VALUES (?, ?, ?)', (big, 'Racer', 2000))
+                other.commit()
+            except sqlite3.OperationalError:
+                blocked.append(big)
+            other.close()
+            return original(cur, big)
+        dpl._bigColumns = racingBigColumns
+        try:
+            response = self.app.post('/dpl/brothers/', data=json.dumps(Karu), content_type='application/json', headers=self.auth)
+        finally:
+            dpl._bigColumns = original
+        assert response.status_code == 200
+        assert blocked == ['Vaporizer']
+
+    def test_connection_pool(self):
+        dpl.pool.clear()
+        hits, misses = dpl.pool.hits, dpl.pool.misses
+        self.app.post(
+            '/dpl/brothers/',
+            data=json.dumps(Vaporizer),
+            content_type='application/json',
+            headers=self.auth
+        )
+        self.app.get('/dpl/brothers/Vaporizer')
+        self.app.get('/dpl/brothers/')
+        # Only the first request has to open a connection
+        assert dpl.pool.misses - misses == 1
+        assert dpl.pool.hits - hits == 2
+        assert dpl.pool.stats()['idle'] == 1
+        with dpl.app.app_context():
+            conn = dpl._get_conn()
+            assert dpl._get_conn() is conn
+            assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+            assert conn.execute('PRAGMA synchronous').fetchone()[0] == 1
+        assert dpl.pool.stats()['idle'] == 1
+
+    def test_migrate_existing_db(self):
+        dpl.pool.clear()
+        os.unlink(dpl.app.config['DATABASE'])
+        conn = sqlite3.connect(dpl.app.config['DATABASE'])
+        conn.execute('CREATE TABLE brothers (nickname TEXT PRIMARY KEY, name TEXT, big TEXT, year INT)')
+        conn.execute('INSERT INTO brothers VALUES (?, ?, ?, ?)', ('Vaporizer', 'Andrew Smith', 'McLovin\'', 2014))
+        conn.execute('INSERT INTO brothers VALUES (?, ?, ?, ?)', ('Karu', 'Kyle Halstead', 'Vaporizer', 2012))
+        conn.commit()
+        conn.close()
+        assert dpl.init_db() == len(dpl.MIGRATIONS)
+        # Running it again is a no-op
+        assert dpl.init_db() == len(dpl.MIGRATIONS)
+        conn = sqlite3.connect(dpl.app.config['DATABASE'])
+        assert conn.execute('PRAGMA user_version').fetchone()[0] == len(dpl.MIGRATIONS)
+        indexes = [row[1] for row in conn.execute('PRAGMA index_list(brothers)')]
+        assert 'brothers_big' in indexes
+        assert 'brothers_year' in indexes
+        assert 'brothers_nickname' in indexes
+        # Bigs in the table are linked by id, the rest kept by nickname
+        rows = conn.execute('SELECT id, nickname, big_id, bigNickname, weight FROM brothers ORDER BY id').fetchall()
+        assert rows == [(1, 'Vaporizer', None, 'McLovin\'', 2), (2, 'Karu', 1, None, 1)]
+        conn.close()
+        response = self.app.get('/dpl/brothers/Vaporizer')
+        vaporizer = json.loads(response.data)
+        assert vaporizer['name'] == 'Andrew Smith'
+        assert vaporizer['big'] == 'McLovin\''
+        assert vaporizer['littles'][0]['big'] == 'Vaporizer'
+        response = self.app.get('/dpl/search?q=Kyle')
+        assert json.loads(response.data)['brothers'][0]['nickname'] == 'Karu'
+
+    def test_rename_writes_one_row(self):
+        for bro in [Vaporizer, Karu, Sanctus]:
+            self.app.post('/dpl/brothers/', data=json.dumps(bro), content_type='application/json', headers=self.auth)
+        conn = sqlite3.connect(dpl.app.config['DATABASE'])
+        conn.execute('CREATE TABLE written (nickname TEXT)')
+        conn.execute('CREATE TRIGGER brothers_written AFTER UPDATE ON brothers BEGIN '
+                     'INSERT INTO written VALUES (new.nickname); END')
+        conn.commit()
+        response = self.app.put(
+            '/dpl/brothers/Vaporizer',
+            data=json.dumps(dict(nickname='Vaporizer2')),
+            content_type='application/json',
+            headers=self.auth
+        )
+        assert response.status_code == 200
+        assert conn.execute('SELECT nickname FROM written').fetchall() == [('Vaporizer2',)]
+        conn.close()
+        vaporizer = json.loads(response.data)
+        assert sorted(little['big'] for little in vaporizer['littles']) == ['Vaporizer2', 'Vaporizer2']
+        # Deleting him leaves his littles waiting on his nickname, and they
+        # are picked up again by whoever next has it
+        self.app.delete('/dpl/brothers/Vaporizer2', headers=self.auth)
+        response = self.app.get('/dpl/brothers/Karu')
+        assert json.loads(response.data)['big'] == 'Vaporizer2'
+        self.app.post('/dpl/brothers/', data=json.dumps(dict(Vaporizer, nickname='Vaporizer2')),
+                      content_type='application/json', headers=self.auth)
+        response = self.app.get('/dpl/brothers/Vaporizer2')
+        assert len(json.loads(response.data)['littles']) == 2
+        assert dpl.verify_db() == []
+
+    def test_query_plans(self):
+        # Every statement dpl.py runs on the brothers outside of migrations,
+        # and what its plan must show, or None where the whole table may be
+        # read. Nothing else may scan the brothers table.
+        nickname = 'INDEX brothers_nickname (nickname=?)'
+        queries = [
+            (dpl.BROTHER_BY_NICKNAME, ('Vaporizer',), nickname),
+            (dpl.LITTLES_OF, ('Vaporizer',), 'INDEX brothers_big (big_id=?)'),
+            (dpl.BROTHER_ID, ('Vaporizer',), nickname),
+            (dpl.BROTHER_EXISTS, ('Vaporizer',), nickname),
+            (dpl.INSERT_BROTHER, ('', '', 1, None, 0), ''),
+            (dpl.UPDATE_BROTHER, ('', 1, None, 0, ''), nickname),
+            (dpl.RELEASE_LITTLES, ('', ''), 'INDEX brothers_big (big_id=?)'),
+            (dpl.DELETE_BROTHER, ('',), nickname),
+            (dpl.RENAME_BROTHER, ('', ''), nickname),
+            (dpl.ADOPT_LITTLES, (1, ''), 'INDEX brothers_bigNickname (bigNickname=?)'),
+            (dpl.AGGREGATE_ROW, (1,), 'INTEGER PRIMARY KEY (rowid=?)'),
+            (dpl.LITTLES_AGGREGATES, (1, 1), 'INDEX brothers_big (big_id=?)'),
+            (dpl.SET_AGGREGATES, (0, 0, 1), 'INTEGER PRIMARY KEY (rowid=?)'),
+            (dpl.FIX_AGGREGATES, (0, 0, ''), nickname),
+            (dpl.ANCESTORS, ('Vaporizer',), nickname),
+            (dpl.DESCENDANTS, ('Vaporizer', 1, 'Vaporizer', -1, 0), 'INDEX brothers_big (big_id=?)'),
+            # Only those waiting on a big by nickname are touched
+            (dpl.RESOLVE_BIGS, (), 'INDEX brothers_bigNickname (bigNickname=?)'),
+            (dpl.UPSERT, ('', '', None, 0), ''),
+            # The brother's own row of the full text index, by rowid
+            (dpl.MATCH_RANK, ('Vapor', 'Vaporizer'), 'brothers_fts VIRTUAL TABLE INDEX 0:='),
+            (dpl.BROTHER_ROWS, (), None),
+            (dpl.REVISION, (), None),
+        ]
+        # Searches filter through an index or the full text index. Unfiltered
+        # pages that sort first on an indexed column seek straight to the
+        # cursor; the rest want every brother anyway.
+        seeks = {('nickname', False): 'INDEX brothers_nickname (nickname>?)',
+                 ('nickname', True): 'INDEX brothers_nickname (nickname<?)',
+                 ('year', False): 'INDEX brothers_year (year>?)'}
+        values = dict(match='Vapor', big='Vaporizer', year=2014, limit=3, after_rank=-1.0)
+        for column in dpl.SEARCH_COLUMNS:
+            values['after_' + column] = 'Karu' if column != 'year' else 2012
+        for match, big, year, order, keyset in dpl.searchShapes():
+            if match:
+                index = 'brothers_fts VIRTUAL TABLE'
+            elif big or year:
+                index = 'INDEX brothers_'
+            elif keyset is False and order[0] in seeks:
+                index = seeks[order[0]]
+            else:
+                index = None
+            queries.append((dpl.makeSearchQuery(match, big, year, order, keyset), values, index))
+        conn = sqlite3.connect(dpl.app.config['DATABASE'])
+        for query, values, index in queries:
+            plan = [row[-1] for row in conn.execute('EXPLAIN QUERY PLAN ' + query, values)]
+            if index is None:
+                continue
+            assert index in ' '.join(plan), (query, plan)
+            assert not [row for row in plan if row.split(' ')[:2] == ['SCAN', 'brothers']], (query, plan)
+            if index in seeks.values():
+                assert 'USE TEMP B-TREE FOR ORDER BY' not in plan, (query, plan)
+        conn.close()
+
+    def test_tree_cache(self):
+        self.app.post(
+            '/dpl/brothers/',
+            data=json.dumps(Vaporizer),
+            content_type='application/json',
+            headers=self.auth
+        )
+        first = self.app.get('/dpl/brothers/')
+        second = self.app.get('/dpl/brothers/')
+        assert first.data == second.data
+        assert first.headers['ETag'] == second.headers['ETag']
+        # A write from another worker is picked up through the revision row
+        conn = sqlite3.connect(dpl.app.config['DATABASE'])
+        conn.execute('UPDATE brothers SET name = ? WHERE nickname = ?', ('Andrew Smorf', 'Vaporizer'))
+        conn.commit()
+        conn.close()
+        response = self.app.get('/dpl/brothers/')
+        assert response.headers['ETag'] != first.headers['ETag']
+        assert json.loads(response.data)['brothers'][0]['name'] == 'Andrew Smorf'
+        response = self.app.get('/dpl/brothers/Vaporizer')
+        assert json.loads(response.data)['name'] == 'Andrew Smorf'
+        # And this worker's own writes invalidate it directly
+        self.app.post(
+            '/dpl/brothers/',
+            data=json.dumps(Karu),
+            content_type='application/json',
+            headers=self.auth
+        )
+        response = self.app.get('/dpl/brothers/')
+        assert len(json.loads(response.data)['brothers']) == 2
+
+    def test_conditional_get(self):
+        self.app.post(
+            '/dpl/brothers/',
+            data=json.dumps(Vaporizer),
+            content_type='application/json',
+            headers=self.auth
+        )
+        self.setRevisionModified(time.time() - 10)
+        for path in ['/dpl/brothers/', '/dpl/brothers/Vaporizer', '/dpl/search?q=Vapor', '/dpl/export/']:
+            response = self.app.get(path)
+            assert response.status_code == 200
+            assert response.data
+            etag = response.headers['ETag']
+            lastModified = response.headers['Last-Modified']
+            response, queries = self.countQueries(self.app.get, path, headers={'If-None-Match': etag})
+            assert response.status_code == 304
+            assert response.data == ''
+            assert response.headers['ETag'] == etag
+            # Only the revision stamp is read
+            assert queries == 1
+            response = self.app.get(path, headers={'If-Modified-Since': lastModified})
+            assert response.status_code == 304
+            response = self.app.get(path, headers={'If-None-Match': '"stale"'})
+            assert response.status_code == 200
+        etag = self.app.get('/dpl/brothers/Vaporizer').headers['ETag']
+        # Different queries on the same endpoint get different ETags
+        assert self.app.get('/dpl/search?q=Vapor').headers['ETag'] != self.app.get('/dpl/search?q=Karu').headers['ETag']
+        self.app.post(
+            '/dpl/brothers/',
+            data=json.dumps(Karu),
+            content_type='application/json',
+            headers=self.auth
+        )
+        response = self.app.get('/dpl/brothers/Vaporizer', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert json.loads(response.data)['littles'][0]['nickname'] == 'Karu'
+        response = self.app.get('/dpl/brothers/spam')
+        assert response.status_code == 404
+        assert 'ETag' not in response.headers
+        # * only matches something that is there
+        response = self.app.get('/dpl/brothers/spam', headers={'If-None-Match': '*'})
+        assert response.status_code == 404
+        for path in ['/dpl/brothers/Vaporizer', '/dpl/export/']:
+            response = self.app.get(path, headers={'If-None-Match': '*'})
+            assert response.status_code == 304
+            assert response.data == ''
+            assert 'ETag' in response.headers
+
+    def test_last_modified_this_second(self):
+        self.app.post('/dpl/brothers/', data=json.dumps(Vaporizer), content_type='application/json', headers=self.auth)
+        # Stamped no earlier than the current second, so another write could
+        # still share it
+        stamp = int(time.time()) + 60
+        self.setRevisionModified(stamp)
+        response = self.app.get('/dpl/brothers/Vaporizer')
+        assert 'Last-Modified' not in response.headers
+        since = http_date(stamp)
+        response = self.app.get('/dpl/brothers/Vaporizer', headers={'If-Modified-Since': since})
+        assert response.status_code == 200
+        self.setRevisionModified(stamp - 120)
+        response = self.app.get('/dpl/brothers/Vaporizer', headers={'If-Modified-Since': since})
+        assert response.status_code == 304
+
+    def test_streamed_tree_json(self):
+        for bro in [Vaporizer, Karu, Sanctus, Dishficks, DumpsterTurtle]:
+            self.app.post(
+                '/dpl/brothers/',
+                data=json.dumps(bro),
+                content_type='application/json',
+                headers=self.auth
+            )
+        dpl.app.config['STREAM_CHUNK_SIZE'] = 64
+        try:
+            with dpl.app.test_request_context('/dpl/brothers/'):
+                brothers = [bro.serialize() for bro in dpl.getTree().values()]
+                expected = dpl.jsonify(brothers=brothers).data
+            streamed = self.app.get('/dpl/brothers/').data
+            # Byte for byte what jsonify would have produced
+            assert streamed == expected
+            assert self.app.get('/dpl/brothers/').data == expected
+            xhr = self.app.get('/dpl/brothers/', headers={'X-Requested-With': 'XMLHttpRequest'}).data
+            assert '\n' not in xhr
+            assert json.loads(xhr) == json.loads(expected)
+            compact = self.app.get('/dpl/brothers/?compact=1').data
+            assert compact == json.dumps(json.loads(expected), separators=(',', ':'), sort_keys=True)
+        finally:
+            dpl.app.config['STREAM_CHUNK_SIZE'] = 16 * 1024
+
+    def test_lineage(self):
+        for bro in [Vaporizer, Karu, Sanctus, DoubleAgent, Dishficks, DumpsterTurtle]:
+            self.app.post(
+                '/dpl/brothers/',
+                data=json.dumps(bro),
+                content_type='application/json',
+                headers=self.auth
+            )
+        self.app.put(
+            '/dpl/add-little/Vaporizer',
+            data=json.dumps(dict(little='Dishficks')),
+            content_type='application/json',
+            headers=self.auth
+        )
+        nicknames = lambda response: [(bro['nickname'], bro['depth']) for bro in json.loads(response.data)['brothers']]
+        response = self.app.get('/dpl/brothers/Dumpster Turtle/ancestors')
+        assert response.status_code == 200
+        assert nicknames(response) == [('Dishficks', 1), ('Vaporizer', 2)]
+        assert json.loads(response.data)['brothers'][1]['name'] == 'Andrew Smith'
+        response = self.app.get('/dpl/brothers/Vaporizer/descendants')
+        assert response.status_code == 200
+        assert nicknames(response) == [('Dishficks', 1), ('Double Agent', 1), ('Karu', 1), ('Sanctus', 1),
+                                       ('Dumpster Turtle', 2)]
+        response = self.app.get('/dpl/brothers/Vaporizer/descendants?depth=1')
+        assert len(nicknames(response)) == 4
+        response = self.app.get('/dpl/brothers/Vaporizer/descendants?limit=2&offset=3')
+        assert nicknames(response) == [('Sanctus', 1), ('Dumpster Turtle', 2)]
+        # Looping big pointers end the walk rather than repeating it
+        self.app.put(
+            '/dpl/add-little/Dumpster Turtle',
+            data=json.dumps(dict(little='Vaporizer')),
+            content_type='application/json',
+            headers=self.auth
+        )
+        response = self.app.get('/dpl/brothers/Dumpster Turtle/ancestors')
+        assert nicknames(response) == [('Dishficks', 1), ('Vaporizer', 2)]
+        response = self.app.get('/dpl/brothers/Vaporizer/descendants')
+        assert len(nicknames(response)) == 5
+        response = self.app.get('/dpl/brothers/Vaporizer/descendants?depth=-1')
+        assert response.status_code == 400
+        response = self.app.get('/dpl/brothers/Vaporizer/descendants?limit=spam')
+        assert response.status_code == 400
+        response = self.app.get('/dpl/brothers/spam/ancestors')
+        assert response.status_code == 404
+        response = self.app.get('/dpl/brothers/spam/descendants')
+        assert response.status_code == 404
+
+    def test_sort_littles_matches_original(self):
+        rand = random.Random(2014)
+        for trial in xrange(2000):
+            # Few distinct weights, so ties are common
+            littles = [Weighted(rand.randint(1, 4)) for i in xrange(rand.randint(0, 40))]
+            expected = sortLittlesByPopping(list(littles))
+            assert [id(i) for i in dpl.Brother.sortLittles(list(littles))] == [id(i) for i in expected]
+
+    def test_deep_lineage(self):
+        # Far deeper than the recursion limit
+        conn = sqlite3.connect(dpl.app.config['DATABASE'])
+        conn.executemany(
+            'INSERT INTO brothers (nickname, name, bigNickname, year) VALUES (?, ?, ?, ?)',
+            [('n{0}'.format(i), 'Name', 'n{0}'.format(i - 1), 2000) for i in xrange(3000)]
+        )
+        conn.execute('UPDATE brothers SET year = ? WHERE nickname = ?', (date.today().year, 'n2999'))
+        conn.commit()
+        conn.close()
+        # Written behind dpl's back, so bigs are only known by nickname and
+        # every stored aggregate but the last brother's is stale until rebuilt
+        assert len(dpl.verify_db()) == 3000
+        assert len(dpl.verify_db(rebuild=True)) == 3000
+        assert dpl.verify_db() == []
+
+        def readRoot():
+            with dpl.app.test_request_context():
+                brother = dpl.Brother('n0').read()
+                return brother.weight, brother.activeBranch
+        # Served from the stored aggregates without walking down
+        (weight, activeBranch), queries = self.countQueries(readRoot)
+        assert weight == 3000
+        assert activeBranch
+        assert queries == 1
+        # Adding to the bottom updates everyone above
+        brother = dict(name='Name', nickname='n3000', big='n2999', year=2000)
+        self.app.post('/dpl/brothers/', data=json.dumps(brother), content_type='application/json', headers=self.auth)
+        (weight, activeBranch), queries = self.countQueries(readRoot)
+        assert weight == 3001
+        assert dpl.verify_db() == []
+        # The whole chain is sent from the root down, read or written. Too
+        # deep for json.loads, so just the brothers in it are counted.
+        responses = [
+            self.app.get('/dpl/brothers/n0'),
+            self.app.put('/dpl/brothers/n0', data=json.dumps(dict(name='Root', big='', year=2000)), content_type='application/json', headers=self.auth),
+            self.app.post('/dpl/batch?littles=1', data=json.dumps(dict(operations=[dict(op='update', nickname='n0', name='Root')])),
+                          content_type='application/json', headers=self.auth),
+        ]
+        for response in responses:
+            assert response.status_code == 200
+            assert response.data.count('"nickname"') == 3001
+
+    def test_stored_aggregates(self):
+        for bro in [Karu, Sanctus, DoubleAgent]:
+            self.app.post('/dpl/brothers/', data=json.dumps(bro), content_type='application/json', headers=self.auth)
+        assert dpl.verify_db() == []
+        # Adopting littles that were already waiting for him
+        self.app.post('/dpl/brothers/', data=json.dumps(Vaporizer), content_type='application/json', headers=self.auth)
+        assert dpl.verify_db() == []
+        with dpl.app.test_request_context():
+            vaporizer = dpl.Brother('Vaporizer').read()
+            assert vaporizer.weight == dpl.getTree()['Vaporizer'].weight
+        changes = [
+            ('put', '/dpl/add-little/Karu', dict(little='Double Agent')),
+            ('put', '/dpl/brothers/Sanctus', dict(Sanctus, year=date.today().year)),
+            ('put', '/dpl/brothers/Karu', dict(Karu, nickname='Karu2')),
+            ('put', '/dpl/brothers/Karu2', dict(Karu, nickname='Karu', big='')),
+            ('delete', '/dpl/brothers/Karu', None),
+            ('put', '/dpl/brothers/Sanctus', dict(Sanctus, year='')),
+        ]
+        for method, path, body in changes:
+            response = getattr(self.app, method)(
+                path,
+                data=json.dumps(body),
+                content_type='application/json',
+                headers=self.auth
+            )
+            assert response.status_code == 200
+            assert dpl.verify_db() == []
+        csvString = 'Name,Nickname,Big,Year\nCory Lauer,Double Agent,Sanctus,2013\nAndrew Smith,Karu,Double Agent,2016'
+        self.app.post(
+            '/dpl/import/',
+            data=dict(file=(StringIO(csvString), 'upload.csv')),
+            content_type='multipart/form-data',
+            headers=self.auth
+        )
+        assert dpl.verify_db() == []
+        conn = sqlite3.connect(dpl.app.config['DATABASE'])
+        conn.execute('UPDATE brothers SET weight = 7 WHERE nickname = ?', ('Sanctus',))
+        conn.commit()
+        conn.close()
+        assert dpl.verify_db() == ['Sanctus']
+        assert dpl.verify_db(rebuild=True) == ['Sanctus']
+        assert dpl.verify_db() == []
+
+    def test_stored_aggregates_with_loop(self):
+        # A -> B -> C -> A, closed by add-little and then by update, each time
+        # cut where a rebuild cuts it
+        for bro in [dict(Karu, nickname='A', big=''), dict(Karu, nickname='B', big='A'),
+                    dict(Karu, nickname='C', big='B')]:
+            self.app.post('/dpl/brothers/', data=json.dumps(bro), content_type='application/json', headers=self.auth)
+        changes = [
+            ('/dpl/add-little/C', dict(little='A')),
+            ('/dpl/brothers/A', dict(Karu, nickname='A', big='')),
+            ('/dpl/brothers/A', dict(Karu, nickname='A', big='C')),
+            ('/dpl/brothers/B', dict(Karu, nickname='B', big='A', year=date.today().year)),
+            ('/dpl/brothers/C', dict(Karu, nickname='C', big='C')),
+        ]
+        for path, body in changes:
+            response = self.app.put(path, data=json.dumps(body), content_type='application/json', headers=self.auth)
+            assert response.status_code == 200
+            assert dpl.verify_db() == []
+        self.app.post('/dpl/brothers/', data=json.dumps(dict(Karu, nickname='D', big='A')),
+                      content_type='application/json', headers=self.auth)
+        self.app.delete('/dpl/brothers/B', headers=self.auth)
+        assert dpl.verify_db() == []
+
+    def test_layout(self):
+        response = self.app.get('/dpl/layout')
+        assert json.loads(response.data) == dict(layout=[], width=0, depth=0)
+        for bro in [Vaporizer, Karu, Sanctus, DoubleAgent, dict(Dishficks, big='')]:
+            self.app.post('/dpl/brothers/', data=json.dumps(bro), content_type='application/json', headers=self.auth)
+        self.app.put('/dpl/add-little/Karu', data=json.dumps(dict(little='Double Agent')), content_type='application/json', headers=self.auth)
+        response = self.app.get('/dpl/layout')
+        data = json.loads(response.data)
+        # Karu is the heavier of Vaporizer's littles, so he comes first, with
+        # Double Agent in the column under him
+        assert data == dict(width=3, depth=3, layout=[
+            dict(nickname='Vaporizer', depth=0, slot=0, span=2),
+            dict(nickname='Karu', depth=1, slot=0, span=1),
+            dict(nickname='Double Agent', depth=2, slot=0, span=1),
+            dict(nickname='Sanctus', depth=1, slot=1, span=1),
+            dict(nickname='Dishficks', depth=0, slot=2, span=1),
+        ])
+        response = self.app.get('/dpl/layout?root=Karu')
+        data = json.loads(response.data)
+        assert data == dict(width=1, depth=2, layout=[
+            dict(nickname='Karu', depth=0, slot=0, span=1),
+            dict(nickname='Double Agent', depth=1, slot=0, span=1),
+        ])
+        # Later requests come from the snapshot without touching the tree
+        with dpl.app.test_request_context():
+            built = dpl.Brother.constructed
+            assert self.app.get('/dpl/layout?root=Karu').data == response.data
+            assert dpl.Brother.constructed == built
+        assert self.app.get('/dpl/layout?root=Nobody').status_code == 404
+
+    def test_columnar(self):
+        for bro in [Vaporizer, Karu, Sanctus, DoubleAgent, dict(Dishficks, big='')]:
+            self.app.post('/dpl/brothers/', data=json.dumps(bro), content_type='application/json', headers=self.auth)
+        self.app.put('/dpl/add-little/Karu', data=json.dumps(dict(little='Double Agent')), content_type='application/json', headers=self.auth)
+        response = self.app.get('/dpl/brothers/?format=columnar')
+        assert response.mimetype == dpl.COLUMNAR_MIMETYPE
+        data = json.loads(response.data)
+        assert data['nicknames'] == ['Vaporizer', 'Karu', 'Double Agent', 'Sanctus', 'Dishficks']
+        assert data['parents'] == [-1, 0, 1, 0, -1]
+        assert data['bigs'] == [Vaporizer['big'], None, None, None, '']
+        assert data['weights'] == [4, 2, 1, 1, 1]
+        # Rebuilt in one pass, it matches the nested tree
+        littles = [[] for nickname in data['nicknames']]
+        for i, parent in enumerate(data['parents']):
+            if parent >= 0:
+                littles[parent].append(data['nicknames'][i])
+        nested = json.loads(self.app.get('/dpl/brothers/').data)['brothers']
+        for bro in nested:
+            i = data['nicknames'].index(bro['nickname'])
+            assert [little['nickname'] for little in bro['littles']] == littles[i]
+            assert (bro['name'], bro['year'], bro['activeBranch']) == (data['names'][i], data['years'][i], data['activeBranches'][i])
+        # Asking through Accept sends the same, with its own ETag
+        accepted = self.app.get('/dpl/brothers/', headers={'Accept': dpl.COLUMNAR_MIMETYPE})
+        assert json.loads(accepted.data) == data
+        assert accepted.headers['ETag'] != self.app.get('/dpl/brothers/').headers['ETag']
+        # Every form of the list says it depends on Accept, 304s included
+        for url in ['/dpl/brothers/', '/dpl/brothers/?format=columnar', '/dpl/brothers/?limit=2',
+                    '/dpl/brothers/?roots_only=1', '/dpl/brothers/?fields=nickname']:
+            response = self.app.get(url)
+            assert 'Accept' in response.vary
+            response = self.app.get(url, headers={'If-None-Match': response.headers['ETag']})
+            assert response.status_code == 304
+            assert 'Accept' in response.vary
+        assert json.loads(self.app.get('/dpl/brothers/?format=columnar&compact=1').data) == data
+        assert self.app.get('/dpl/brothers/?format=xml').status_code == 400
+        assert self.app.get('/dpl/brothers/?format=columnar&limit=2').status_code == 400
+
+    def test_roots_with_loop(self):
+        # C and D are each other's big, so one of them has to head the lineage
+        for bro in [dict(Karu, nickname='C', big='D'), dict(Karu, nickname='D', big='C'), dict(Dishficks, big='')]:
+            self.app.post('/dpl/brothers/', data=json.dumps(bro), content_type='application/json', headers=self.auth)
+        page = json.loads(self.app.get('/dpl/brothers/?roots_only=1&fields=nickname,weight').data)
+        assert page['brothers'] == [{'nickname': 'C', 'weight': 2}, {'nickname': 'Dishficks', 'weight': 1}]
+        layout = json.loads(self.app.get('/dpl/layout').data)
+        assert layout == dict(width=2, depth=2, layout=[
+            dict(nickname='C', depth=0, slot=0, span=1),
+            dict(nickname='D', depth=1, slot=0, span=1),
+            dict(nickname='Dishficks', depth=0, slot=1, span=1),
+        ])
+        columnar = json.loads(self.app.get('/dpl/brothers/?format=columnar').data)
+        assert columnar['nicknames'] == [node['nickname'] for node in layout['layout']]
+
+    def test_batch(self):
+        operations = [
+            dict(Vaporizer, op='create'),
+            dict(Karu, op='create', big=''),
+            dict(Sanctus, op='create'),
+            dict(op='add-little', nickname='Vaporizer', little='Karu'),
+            dict(op='rename', nickname='Sanctus', to='Sanctus2'),
+            dict(op='update', nickname='Karu', name='Kyle H.', big='Vaporizer', year=2011),
+            dict(DoubleAgent, op='create'),
+            dict(op='delete', nickname='Double Agent'),
+        ]
+        response = self.app.post('/dpl/batch', data=json.dumps(dict(operations=operations)),
+                                 content_type='application/json', headers=self.auth)
+        assert response.status_code == 200
+        results = json.loads(response.data)['results']
+        assert results[3] == dict(op='add-little', name='Kyle Halstead', nickname='Karu', big='Vaporizer', year=2012)
+        assert results[4] == dict(op='rename', name='Michael Higgins', nickname='Sanctus2', big='Vaporizer', year=2013)
+        assert results[5]['name'] == 'Kyle H.'
+        assert results[7] == dict(op='delete', nickname='Double Agent')
+        assert 'littles' not in results[0]
+        assert dpl.verify_db() == []
+        response = self.app.get('/dpl/brothers/Vaporizer')
+        vaporizer = json.loads(response.data)
+        assert sorted(little['nickname'] for little in vaporizer['littles']) == ['Karu', 'Sanctus2']
+        # Subtrees only when asked for
+        operations = [dict(op='update', nickname='Vaporizer', name='Andy Smith')]
+        response = self.app.post('/dpl/batch?littles=1', data=json.dumps(dict(operations=operations)),
+                                 content_type='application/json', headers=self.auth)
+        result = json.loads(response.data)['results'][0]
+        assert len(result['littles']) == 2
+        assert result['name'] == 'Andy Smith'
+        # Each result keeps his fields from right after his own operation
+        operations = [
+            dict(DoubleAgent, op='create'),
+            dict(op='update', nickname='Double Agent', name='Cory L.', big='Vaporizer', year=2015),
+        ]
+        response = self.app.post('/dpl/batch?littles=1', data=json.dumps(dict(operations=operations)),
+                                 content_type='application/json', headers=self.auth)
+        results = json.loads(response.data)['results']
+        assert (results[0]['name'], results[0]['year']) == ('Cory Lauer', 2013)
+        assert (results[1]['name'], results[1]['year']) == ('Cory L.', 2015)
+        assert results[0]['littles'] == results[1]['littles'] == []
+        assert results[0]['activeBranch'] == results[1]['activeBranch'] == False
+        response = self.app.post('/dpl/batch', data=json.dumps(dict(operations=operations)),
+                                 content_type='application/json')
+        assert response.status_code == 401
+
+    def test_batch_is_all_or_nothing(self):
+        self.app.post('/dpl/brothers/', data=json.dumps(Vaporizer), content_type='application/json', headers=self.auth)
+        before = self.app.get('/dpl/brothers/').data
+        failures = [
+            (dict(op='create', nickname='Karu', name='Again'), 409),
+            (dict(op='update', nickname='Nobody', name='Nobody'), 404),
+            (dict(op='add-little', nickname='Vaporizer', little='Nobody'), 404),
+            (dict(op='create', nickname='Karu'), 400),
+            (dict(op='promote', nickname='Karu'), 400),
+            (dict(op=['create'], nickname='Karu'), 400),
+            (dict(op='create', nickname=['Karu'], name='Kyle Halstead'), 400),
+            (dict(op='update', nickname='Karu', name={'first': 'Kyle'}), 400),
+            (dict(op='rename', nickname='Karu', to=7), 400),
+            (dict(op='add-little', nickname='Vaporizer', little=None), 400),
+            (dict(op='create', nickname='Sanctus', name='Michael Higgins', big=['Karu']), 400),
+            (dict(op='create', nickname='Sanctus', name='Michael Higgins', year=[2013]), 400),
+        ]
+        for failure, status in failures:
+            operations = [dict(Karu, op='create'), dict(op='delete', nickname='Vaporizer'), failure]
+            response = self.app.post('/dpl/batch', data=json.dumps(dict(operations=operations)),
+                                     content_type='application/json', headers=self.auth)
+            assert response.status_code == status
+            assert json.loads(response.data)['index'] == 2
+            assert self.app.get('/dpl/brothers/').data == before
+        for body in [dict(), dict(operations='create'), []]:
+            response = self.app.post('/dpl/batch', data=json.dumps(body),
+                                     content_type='application/json', headers=self.auth)
+            assert response.status_code == 400
+
+    def test_relation(self):
+        turtle = dict(DumpsterTurtle, big='Karu')
+        for bro in [Vaporizer, Karu, Sanctus, turtle, dict(Dishficks, big='')]:
+            self.app.post('/dpl/brothers/', data=json.dumps(bro), content_type='application/json', headers=self.auth)
+        response = self.app.get('/dpl/relation?a=Dumpster Turtle&b=Sanctus')
+        assert response.status_code == 200
+        assert json.loads(response.data)['relations'] == [dict(
+            a='Dumpster Turtle',
+            b='Sanctus',
+            ancestor='Vaporizer',
+            aPath=['Dumpster Turtle', 'Karu', 'Vaporizer'],
+            bPath=['Sanctus', 'Vaporizer'],
+            distance=3,
+            generations=1
+        )]
+        # Several pairs at once, in order
+        response = self.app.get('/dpl/relation?a=Karu&b=Vaporizer&a=Dishficks&b=Karu&a=Karu&b=Karu')
+        relations = json.loads(response.data)['relations']
+        assert [relation['ancestor'] for relation in relations] == ['Vaporizer', None, 'Karu']
+        assert relations[0]['generations'] == 1
+        assert relations[1]['distance'] is None
+        assert relations[2]['distance'] == 0
+        response = self.app.post('/dpl/relation', data=json.dumps(dict(pairs=[['Vaporizer', 'Dumpster Turtle']])),
+                                 content_type='application/json')
+        assert json.loads(response.data)['relations'][0]['generations'] == -2
+        # Tables are rebuilt after writes
+        self.app.put('/dpl/add-little/Sanctus', data=json.dumps(dict(little='Dumpster Turtle')),
+                     content_type='application/json', headers=self.auth)
+        response = self.app.get('/dpl/relation?a=Dumpster Turtle&b=Sanctus')
+        assert json.loads(response.data)['relations'][0]['ancestor'] == 'Sanctus'
+        assert self.app.get('/dpl/relation?a=Karu&b=Nobody').status_code == 404
+        assert self.app.get('/dpl/relation?a=Karu').status_code == 400
+        response = self.app.post('/dpl/relation', data=json.dumps(dict(pairs=[['Karu']])),
+                                 content_type='application/json')
+        assert response.status_code == 400
+
+    def test_tree_store_matches_brothers(self):
+        rand = random.Random(5)
+        for trial in xrange(20):
+            nicknames = ['n{0}'.format(i) for i in xrange(rand.randint(1, 60))]
+            # Bigs anywhere, so there are loops and brothers outside the table
+            rows = [(nickname, '', rand.choice(nicknames + ['Ghost']), rand.randint(1990, 2030)) for nickname in nicknames]
+            with dpl.app.test_request_context():
+                store = dpl.buildTree(rows)
+                littles = dict((nickname, []) for nickname in nicknames)
+                brothers = dict((row[0], dpl.Brother(*row, littles=littles[row[0]])) for row in rows)
+                for row in rows:
+                    if row[2] in littles:
+                        littles[row[2]].append(brothers[row[0]])
+                # In table order, as buildTree walks, so loops are cut alike
+                for nickname in nicknames:
+                    brothers[nickname].aggregate()
+                assert list(store) == nicknames
+                for nickname in nicknames:
+                    stored, brother = store[nickname], brothers[nickname]
+                    assert not hasattr(stored, '__dict__')
+                    assert [little.nickname for little in stored.littles] == [little.nickname for little in brother.littles]
+                    assert (stored.weight, stored.activeBranch, stored.big) == (brother.weight, brother.activeBranch, brother.big)
+                    # Interned, so known bigs are their brother's own nickname
+                    assert stored.big == 'Ghost' or stored.big is store[stored.big].nickname
+
+    def test_relation_matches_walking_up(self):
+        rand = random.Random(3)
+        for trial in xrange(20):
+            nicknames = ['n{0}'.format(i) for i in xrange(rand.randint(1, 60))]
+            # Bigs anywhere, so there are loops and brothers outside the table
+            rows = [(nickname, '', rand.choice(nicknames + ['Ghost']), 2000) for nickname in nicknames]
+            with dpl.app.test_request_context():
+                tree = dpl.buildTree(rows)
+                lineages = dpl.Lineages(tree)
+            assert sorted(lineages.nicknames) == sorted(nicknames)
+            parents = dict((lineages.nicknames[i], lineages.nicknames[up]) for i, up in enumerate(lineages.up[0]) if up >= 0)
+            assert all(tree[nickname].big == big for nickname, big in parents.items())
+
+            def walkUp(nickname):
+                path = [nickname]
+                while path[-1] in parents:
+                    path.append(parents[path[-1]])
+                return path
+            for i in xrange(50):
+                a, b = rand.choice(nicknames), rand.choice(nicknames)
+                relation = lineages.relation(a, b)
+                aUp, bUp = walkUp(a), walkUp(b)
+                common = [nickname for nickname in aUp if nickname in bUp]
+                if not common:
+                    assert relation['ancestor'] is None
+                    continue
+                assert relation['ancestor'] == common[0]
+                assert relation['aPath'] == aUp[:aUp.index(common[0]) + 1]
+                assert relation['bPath'] == bUp[:bUp.index(common[0]) + 1]
+                assert relation['distance'] == len(relation['aPath']) + len(relation['bPath']) - 2
+
+    def test_metrics(self):
+        assert self.app.get('/dpl/metrics').status_code == 404
+        self.app.post('/dpl/brothers/', data=json.dumps(Vaporizer), content_type='application/json', headers=self.auth)
+        dpl.app.config['METRICS'] = True
+        dpl.app.config['METRICS_DATABASE'] = dpl.app.config['DATABASE'] + '.metrics'
+        lines = []
+        handler = logging.Handler()
+        handler.emit = lambda record: lines.append(json.loads(record.getMessage()))
+        dpl.metricsLog.addHandler(handler)
+        dpl.metricsLog.setLevel(logging.INFO)
+        try:
+            # Totals are recorded once the server closes the response
+            self.app.post('/dpl/brothers/', data=json.dumps(Karu), content_type='application/json', headers=self.auth).close()
+            # Built afresh, as a worker that didn't make the write would
+            dpl.invalidateSnapshot()
+            response = self.app.get('/dpl/brothers/Vaporizer')
+            response.close()
+            # The revision stamp and the table, building both brothers
+            timing = response.headers['Server-Timing']
+            assert 'sql;dur=' in timing
+            assert 'desc="2 queries, 3 rows"' in timing
+            assert 'desc="2 constructed"' in timing
+            assert 'desc="0 opened"' in timing
+            assert lines[-1]['endpoint'] == 'readOne'
+            assert lines[-1]['status'] == 200
+            assert lines[-1]['sql_queries'] == 2
+            assert lines[-1]['serialize_seconds'] > 0
+            response = self.app.get('/dpl/metrics')
+            assert response.headers['Content-Type'] == 'text/plain; version=0.0.4'
+            body = response.data.splitlines()
+            assert '# TYPE dpl_requests_total counter' in body
+            assert 'dpl_requests_total{endpoint="readOne"} 1.0' in body
+            assert 'dpl_requests_total{endpoint="create"} 1.0' in body
+            assert 'dpl_sql_queries_total{endpoint="readOne"} 2.0' in body
+            assert 'dpl_connections_opened_total{endpoint="create"} 1.0' in body
+        finally:
+            dpl.metricsLog.removeHandler(handler)
+            dpl.app.config['METRICS'] = False
+            dpl.metricsStore.close()
+            for suffix in ['', '-wal', '-shm']:
+                if os.path.exists(dpl.app.config['METRICS_DATABASE'] + suffix):
+                    os.unlink(dpl.app.config['METRICS_DATABASE'] + suffix)
+
     def test_search_with_query(self):
         self.app.post(
             '/dpl/brothers/',
@@ -388,24 +1313,66 @@ class DplTestCase(unittest.TestCase):
             content_type='application/json',
             headers=self.auth
         )
+        # q matches the start of any word of a nickname or name
         response = self.app.get('/dpl/search?q=Vapor')
-        expected = dict(brothers=[Vaporizer, Karu, Sanctus])
+        expected = dict(brothers=[Vaporizer])
         assert response.status_code == 200
         assert json.loads(response.data) == expected
 
-        response = self.app.get('/dpl/search?q=201')
+        response = self.app.get('/dpl/search?q=Andr')
         assert response.status_code == 200
         assert json.loads(response.data) == expected
 
-        response = self.app.get('/dpl/search?q=Andr')
+        response = self.app.get('/dpl/search?q=andrew+smi')
         assert response.status_code == 200
-        expected = dict(brothers=[Vaporizer])
         assert json.loads(response.data) == expected
 
-        response = self.app.get('/dpl/search?q=McL')
+        response = self.app.get('/dpl/search?q=h')
+        expected = dict(brothers=[Karu, Sanctus])
+        assert response.status_code == 200
+        assert sorted(json.loads(response.data)['brothers']) == sorted(expected['brothers'])
+
+        # Bigs and years are not searched, nor the middle of words
+        for query in ['McL', '201', 'porizer']:
+            response = self.app.get('/dpl/search?q=' + query)
+            assert response.status_code == 200
+            assert json.loads(response.data) == dict(brothers=[])
+
+        response = self.app.get('/dpl/search?name=Kyle')
+        expected = dict(brothers=[Karu])
         assert response.status_code == 200
         assert json.loads(response.data) == expected
 
+        response = self.app.get('/dpl/search?nickname=Kyle')
+        assert response.status_code == 200
+        assert json.loads(response.data) == dict(brothers=[])
+
+        # Terms without a single word match nobody rather than everybody
+        for query in ['q=-', 'q=%20', 'name=%22', 'nickname=*&q=Kyle']:
+            response = self.app.get('/dpl/search?' + query)
+            assert response.status_code == 200
+            assert json.loads(response.data) == dict(brothers=[])
+
+    def test_search_ranking(self):
+        for bro in [
+            dict(name='Sam Sample', nickname='Sam', big='', year=2014),
+            dict(name='Kyle Halstead', nickname='Samwise', big='', year=2014),
+            dict(name='Sam Samson Samuels', nickname='Sammy', big='', year=2014),
+        ]:
+            self.app.post('/dpl/brothers/', data=json.dumps(bro), content_type='application/json', headers=self.auth)
+        response = self.app.get('/dpl/search?q=sam&fields=nickname')
+        assert json.loads(response.data)['brothers'] == [{'nickname': 'Sammy'}, {'nickname': 'Sam'}, {'nickname': 'Samwise'}]
+        # Pages keep to the ranking
+        response = self.app.get('/dpl/search?q=sam&fields=nickname&limit=1&after=Sammy')
+        assert json.loads(response.data) == {'brothers': [{'nickname': 'Sam'}], 'next': 'Sam'}
+        # Renames and deletes reach the index
+        self.app.put('/dpl/brothers/Sammy', data=json.dumps(dict(nickname='Bob')), content_type='application/json', headers=self.auth)
+        self.app.delete('/dpl/brothers/Sam', headers=self.auth)
+        response = self.app.get('/dpl/search?nickname=sam&fields=nickname')
+        assert json.loads(response.data)['brothers'] == [{'nickname': 'Samwise'}]
+        response = self.app.get('/dpl/search?q=bob&fields=nickname')
+        assert json.loads(response.data)['brothers'] == [{'nickname': 'Bob'}]
+
     def test_search_with_year(self):
         self.app.post(
             '/dpl/brothers/',
@@ -425,8 +1392,9 @@ class DplTestCase(unittest.TestCase):
             content_type='application/json',
             headers=self.auth
         )
+        # Years must match exactly
         response = self.app.get('/dpl/search?year=201')
-        expected = dict(brothers=[Vaporizer, Karu, Sanctus])
+        expected = dict(brothers=[])
         assert response.status_code == 200
         assert json.loads(response.data) == expected
 
@@ -454,16 +1422,22 @@ class DplTestCase(unittest.TestCase):
             content_type='application/json',
             headers=self.auth
         )
-        response = self.app.get('/dpl/search?big=i')
-        expected = dict(brothers=[Vaporizer, Karu, Sanctus])
+        # Bigs must match exactly
+        response = self.app.get('/dpl/search?big=McL')
+        expected = dict(brothers=[])
         assert response.status_code == 200
         assert json.loads(response.data) == expected
 
-        response = self.app.get('/dpl/search?big=McL')
+        response = self.app.get('/dpl/search?big=McLovin\'')
         assert response.status_code == 200
         expected = dict(brothers=[Vaporizer])
         assert json.loads(response.data) == expected
 
+        response = self.app.get('/dpl/search?big=Vaporizer')
+        assert response.status_code == 200
+        expected = dict(brothers=[Karu, Sanctus])
+        assert json.loads(response.data) == expected
+
     def test_search_with_big_and_year(self):
         self.app.post(
             '/dpl/brothers/',
@@ -546,6 +1520,93 @@ class DplTestCase(unittest.TestCase):
         assert response.status_code == 200
         assert json.loads(response.data) == expected
 
+        # Ties are broken by nickname without paging too
+        response = self.app.get('/dpl/search?sort=big')
+        assert json.loads(response.data) == expected
+
+        response = self.app.get('/dpl/search?sort=-big&sort=-year')
+        expected = dict(brothers=[Sanctus, Karu, Vaporizer])
+        assert response.status_code == 200
+        assert json.loads(response.data) == expected
+
+    def test_search_statements(self):
+        for bro in [Vaporizer, Karu, Sanctus]:
+            self.app.post('/dpl/brothers/', data=json.dumps(bro), content_type='application/json', headers=self.auth)
+        for sort in ['name;DROP TABLE brothers', '--year', 'weight', '']:
+            assert self.app.get('/dpl/search?sort=' + sort).status_code == 400
+        # Different values, repeated columns and anything after nickname all
+        # come down to the one statement
+        before = dpl.searchStatements.stats()
+        for query in ['q=kyle&year=2012&sort=-year', 'q=mich&year=2013&sort=-year&sort=year', 'q=a&year=1&sort=-year']:
+            assert self.app.get('/dpl/search?' + query).status_code == 200
+        for query in ['sort=-nickname', 'sort=-nickname&sort=name', 'sort=-nickname&sort=-nickname']:
+            assert self.app.get('/dpl/search?' + query).status_code == 200
+        after = dpl.searchStatements.stats()
+        assert after['statements'] - before['statements'] <= 2
+        assert after['hits'] - before['hits'] >= 4
+        response = self.app.get('/dpl/search?q=kyle&year=2012&sort=-year')
+        assert json.loads(response.data) == dict(brothers=[Karu])
+
+    def test_paginated_brothers(self):
+        # Other tests leave a big on the shared Dishficks
+        for bro in [Vaporizer, Karu, Sanctus, DoubleAgent, dict(Dishficks, big=''), DumpsterTurtle]:
+            self.app.post('/dpl/brothers/', data=json.dumps(bro), content_type='application/json', headers=self.auth)
+        everyone = json.loads(self.app.get('/dpl/brothers/').data)
+        assert 'next' not in everyone
+        byNickname = dict((bro['nickname'], bro) for bro in everyone['brothers'])
+        pages = []
+        path = '/dpl/brothers/?limit=4'
+        while True:
+            page = json.loads(self.app.get(path).data)
+            pages.extend(page['brothers'])
+            if 'next' not in page:
+                break
+            path = '/dpl/brothers/?limit=4&after=' + page['next']
+        assert pages == [byNickname[nickname] for nickname in sorted(byNickname)]
+        # A cursor whose brother is gone still works
+        page = json.loads(self.app.get('/dpl/brothers/?after=E&fields=nickname').data)
+        assert page == {'brothers': [{'nickname': 'Karu'}, {'nickname': 'Sanctus'}, {'nickname': 'Vaporizer'}]}
+        page = json.loads(self.app.get('/dpl/brothers/?roots_only=1').data)
+        assert page['brothers'] == [
+            dict(Vaporizer, activeBranch=False, weight=4),
+            dict(name='Sebastian Espinosa', nickname='Dishficks', big='', year=2017, activeBranch=True, weight=2)
+        ]
+        page = json.loads(self.app.get('/dpl/brothers/?roots_only=1&limit=1&fields=nickname,weight').data)
+        assert page == {'brothers': [{'nickname': 'Dishficks', 'weight': 2}], 'next': 'Dishficks'}
+        page = json.loads(self.app.get('/dpl/brothers/?fields=nickname&fields=littles&limit=1&after=Dishficks').data)
+        assert page['brothers'] == [{'nickname': 'Double Agent', 'littles': []}]
+        assert self.app.get('/dpl/brothers/?fields=password').status_code == 400
+        assert self.app.get('/dpl/brothers/?roots_only=1&fields=nickname,littles').status_code == 400
+        assert self.app.get('/dpl/brothers/?limit=0').status_code == 400
+
+    def test_paginated_search(self):
+        for bro in [Vaporizer, Karu, Sanctus, DoubleAgent, Dishficks, DumpsterTurtle]:
+            self.app.post('/dpl/brothers/', data=json.dumps(bro), content_type='application/json', headers=self.auth)
+        everyone = json.loads(self.app.get('/dpl/search?sort=-year&sort=nickname').data)['brothers']
+        for sort in ['', '&sort=-year', '&sort=big&sort=-nickname', '&sort=year&sort=-nickname',
+                     '&sort=big&sort=-year', '&sort=-big&sort=year&sort=name']:
+            pages = []
+            path = '/dpl/search?limit=2' + sort
+            while True:
+                page = json.loads(self.app.get(path).data)
+                assert len(page['brothers']) <= 2
+                pages.extend(page['brothers'])
+                if 'next' not in page:
+                    break
+                path = '/dpl/search?limit=2&after=' + page['next'] + sort
+            assert sorted(pages) == sorted(everyone)
+            assert len(pages) == len(everyone)
+            if sort == '&sort=-year':
+                assert pages == everyone
+        page = json.loads(self.app.get('/dpl/search?sort=-year&limit=2&fields=nickname').data)
+        assert page == {'brothers': [{'nickname': 'Dumpster Turtle'}, {'nickname': 'Dishficks'}], 'next': 'Dishficks'}
+        page = json.loads(self.app.get('/dpl/search?after=Karu&fields=nickname,year').data)
+        assert page == {'brothers': [{'nickname': 'Sanctus', 'year': 2013}, {'nickname': 'Vaporizer', 'year': 2014}]}
+        assert self.app.get('/dpl/search?after=Nobody&sort=year').status_code == 400
+        assert self.app.get('/dpl/search?fields=littles').status_code == 400
+        # Every statement stays prepared
+        assert len(dpl.searchShapes()) + 64 <= dpl.app.config['DB_STATEMENT_CACHE']
+
     def test_csv_upload(self):
         csvString = 'Name,Nickname,Big,Year\nAndrew Smith,Vaporizer,McLovin\',2014\nKyle Halstead,Karu,Vaporizer,2012'
         response = self.app.post('/dpl/import/')
@@ -590,6 +1651,41 @@ class DplTestCase(unittest.TestCase):
         response = self.app.get('/dpl/brothers/')
         assert json.loads(response.data) == expected
 
+    def test_csv_upload_batches(self):
+        csvString = '\n'.join([
+            'Name,Nickname,Big,Year',
+            'Andrew Smith,Vaporizer,McLovin\',2014',
+            'Kyle Halstead,Karu,Vaporizer,2012',
+            'Nobody,,Vaporizer,2012',
+            'Michael Higgins,Sanctus,Vaporizer,2013',
+            'Cory Lauer,Double Agent,Vaporizer,2013',
+            'Andrew Smoth,Vaporizer,McLovin\',2014'
+        ])
+        dpl.app.config['IMPORT_BATCH_SIZE'] = 2
+        try:
+            response = self.app.post(
+                '/dpl/import/',
+                data=dict(file=(StringIO(csvString), 'upload.csv')),
+                content_type='multipart/form-data',
+                headers=self.auth
+            )
+        finally:
+            dpl.app.config['IMPORT_BATCH_SIZE'] = 500
+        assert response.status_code == 200
+        assert response.data == 'Errors found with this import:\nLine 4 has no nickname'
+        response = self.app.get('/dpl/brothers/Vaporizer')
+        brother = json.loads(response.data)
+        # Later rows win, like importing them one at a time
+        assert brother['name'] == 'Andrew Smoth'
+        assert len(brother['littles']) == 3
+        response = self.app.post(
+            '/dpl/import/',
+            data=dict(file=(StringIO('Name,Nickname\nAndrew Smith,Vaporizer'), 'upload.csv')),
+            content_type='multipart/form-data',
+            headers=self.auth
+        )
+        assert response.status_code == 400
+
     def test_csv_download(self):
         response = self.app.post(
             '/dpl/brothers/',
@@ -603,6 +1699,113 @@ class DplTestCase(unittest.TestCase):
                     'Andrew Smith,Vaporizer,McLovin\',2014']
         assert response.data.splitlines() == expected
 
+    def test_csv_download_closed_early(self):
+        self.app.post('/dpl/brothers/', data=json.dumps(Vaporizer), content_type='application/json', headers=self.auth)
+        with dpl.app.test_request_context():
+            chunks = dpl.iterExport()
+            next(chunks)
+            next(chunks)
+            chunks.close()
+            # The read transaction is already over, so writes since are seen
+            other = sqlite3.connect(dpl.app.config['DATABASE'])
+            other.execute('UPDATE brothers SET name = ?', ('Andy Smith',))
+            other.commit()
+            other.close()
+            name = dpl._get_conn().execute('SELECT name FROM brothers').fetchone()[0]
+            assert name == 'Andy Smith'
+
+    def test_csv_download_gzip(self):
+        for bro in [Vaporizer, Karu]:
+            self.app.post(
+                '/dpl/brothers/',
+                data=json.dumps(bro),
+                content_type='application/json',
+                headers=self.auth
+            )
+        dpl.app.config['EXPORT_BATCH_SIZE'] = 1
+        dpl.app.config['COMPRESS_MIN_SIZE'] = 0
+        try:
+            plain = self.app.get('/dpl/export/')
+            response = self.app.get('/dpl/export/', headers={'Accept-Encoding': 'gzip'})
+            assert response.status_code == 200
+            assert response.headers['Content-Encoding'] == 'gzip'
+            assert response.headers['Content-Disposition'] == 'attachment; filename=brothers.csv'
+            assert GzipFile(fileobj=StringIO(response.data)).read() == plain.data
+            assert plain.data.splitlines() == [
+                'Name,Nickname,Big,Year',
+                'Andrew Smith,Vaporizer,McLovin\',2014',
+                'Kyle Halstead,Karu,Vaporizer,2012'
+            ]
+        finally:
+            dpl.app.config['EXPORT_BATCH_SIZE'] = 500
+            dpl.app.config['COMPRESS_MIN_SIZE'] = 1024
+
+    def test_compressed_download_closed_early(self):
+        for bro in [Vaporizer, Karu, Sanctus]:
+            self.app.post('/dpl/brothers/', data=json.dumps(bro), content_type='application/json', headers=self.auth)
+        dpl.app.config['EXPORT_BATCH_SIZE'] = 1
+        dpl.app.config['COMPRESS_MIN_SIZE'] = 0
+        # Nothing may be left for the cycle collector to clean up
+        gc.disable()
+        try:
+            idle = dpl.pool.stats()['idle']
+            response = self.app.get('/dpl/export/', headers={'Accept-Encoding': 'gzip'}, buffered=False)
+            next(iter(response.response))
+            assert dpl.pool.stats()['idle'] == idle - 1
+            response.close()
+            assert dpl.pool.stats()['idle'] == idle
+            assert self.app.get('/dpl/brothers/Karu').status_code == 200
+        finally:
+            gc.enable()
+            dpl.app.config['EXPORT_BATCH_SIZE'] = 500
+            dpl.app.config['COMPRESS_MIN_SIZE'] = 1024
+
+    def test_compressed_reads(self):
+        for i in xrange(60):
+            bro = dict(Vaporizer, nickname='Bro{0}'.format(i), big='Bro{0}'.format(i // 2) if i else '')
+            self.app.post('/dpl/brothers/', data=json.dumps(bro), content_type='application/json', headers=self.auth)
+        decompress = dict(gzip=lambda data: GzipFile(fileobj=StringIO(data)).read(), deflate=zlib.decompress)
+        for url in ['/dpl/brothers/', '/dpl/brothers/?limit=20', '/dpl/brothers/?format=columnar',
+                    '/dpl/search?q=Andrew', '/dpl/export/']:
+            plain = self.app.get(url)
+            # Read now, or the rest of a streamed body would share the next
+            # request's connection in the test client
+            plain.data
+            assert 'Content-Encoding' not in plain.headers
+            assert 'Accept-Encoding' in plain.headers['Vary']
+            for coding in ['gzip', 'deflate']:
+                response = self.app.get(url, headers={'Accept-Encoding': coding})
+                assert response.headers['Content-Encoding'] == coding
+                assert response.headers['Content-Type'] == plain.headers['Content-Type']
+                assert 'Accept-Encoding' in response.headers['Vary']
+                assert decompress[coding](response.data) == plain.data
+                assert response.headers['ETag'] != plain.headers['ETag']
+                if 'Content-Length' in response.headers:
+                    assert int(response.headers['Content-Length']) == len(response.data)
+                response = self.app.get(url, headers={'Accept-Encoding': coding, 'If-None-Match': response.headers['ETag']})
+                assert response.status_code == 304
+                assert 'Accept-Encoding' in response.vary
+        assert self.app.get('/dpl/export/').headers['Content-Type'] == 'text/csv; charset=utf-8'
+        # Preferences are honoured, gzip wins a tie and q=0 turns a coding off
+        assert self.app.get('/dpl/brothers/', headers={'Accept-Encoding': 'gzip;q=0.5, deflate'}).headers['Content-Encoding'] == 'deflate'
+        assert self.app.get('/dpl/brothers/', headers={'Accept-Encoding': 'deflate, gzip'}).headers['Content-Encoding'] == 'gzip'
+        assert 'Content-Encoding' not in self.app.get('/dpl/brothers/', headers={'Accept-Encoding': 'gzip;q=0'}).headers
+        # Small bodies go out as they are
+        response = self.app.get('/dpl/brothers/Bro0', headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in response.headers
+        response = self.app.get('/dpl/search?q=Bro59', headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in response.headers
+        # The cached tree is compressed once per revision
+        compressed = []
+        original = dpl.compress
+        dpl.compress = lambda body, coding: compressed.append(coding) or original(body, coding)
+        try:
+            first = self.app.get('/dpl/brothers/?format=columnar', headers={'Accept-Encoding': 'gzip'}).data
+            assert self.app.get('/dpl/brothers/?format=columnar', headers={'Accept-Encoding': 'gzip'}).data == first
+            assert compressed == []
+        finally:
+            dpl.compress = original
+
     def test_bad_request(self):
         response = self.app.post(
             '/dpl/brothers/',
@@ -671,6 +1874,8 @@ class DplTestCase(unittest.TestCase):
             headers=self.auth
         )
         os.chmod(dpl.app.config['DATABASE'], 0400)
+        # Pooled connections were opened before the chmod and stay writable
+        dpl.pool.clear()
         response = self.app.delete(
             '/dpl/brothers/Vaporizer',
             headers=self.auth
@@ -1,3 +1,15 @@
 #!/usr/bin/python
-from dpl import init_db
-init_db()
+import argparse
+from dpl import init_db, verify_db
+
+parser = argparse.ArgumentParser(description='Creates or upgrades the database')
+parser.add_argument('--verify', action='store_true', help='report brothers whose stored weight or latest year has drifted')
+parser.add_argument('--rebuild', action='store_true', help='link up bigs given by nickname and recompute every stored weight and latest year')
+args = parser.parse_args()
+
+print 'Database is at schema version {0}'.format(init_db())
+if args.verify or args.rebuild:
+    drifted = verify_db(rebuild=args.rebuild)
+    for nickname in drifted:
+        print nickname
+    print '{0:d} brothers {1}'.format(len(drifted), 'rebuilt' if args.rebuild else 'out of date')